@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark metric_datapoint_export and metric_export end to end against the
+in-process fake Lightup API in fake_lightup.py, no Lightup cluster is needed.
+
+Each exporter runs in its own subprocess so its peak RSS is measured in
+isolation. Reports rows, rows/sec, peak RSS and the fake API request counts
+per endpoint. Use --latency to model the network round trip, which is what
+--concurrency and --workers overlap.
+
+See usage: python bench_export.py --help
+"""
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import arrow
+
+from scripts.benchmarks.fake_lightup import Workload, install
+
+EXPORTERS = ["metric_datapoint_export", "metric_export"]
+
+
+def get_workload(args) -> Workload:
+    end_ts = arrow.utcnow().floor("day")
+    return Workload(
+        workspaces=args.workspaces,
+        metrics=args.metrics,
+        monitors_per_metric=args.monitors,
+        slices=args.slices,
+        interval=args.interval,
+        incidents_per_monitor=args.incidents,
+        start_ts=end_ts.shift(days=-args.days).timestamp(),
+        end_ts=end_ts.timestamp(),
+    )
+
+
+def run_exporter(exporter: str, args) -> dict:
+    """runs the exporter in this process, returns its benchmark results"""
+    fake = install(get_workload(args), args.latency)
+    module = importlib.import_module(f"scripts.export.{exporter}")
+
+    with tempfile.TemporaryDirectory() as export_dir:
+        module.EXPORT_DIRECTORY_PATH = export_dir
+        module.EXPORT_FORMAT = args.format
+        module.WORKERS = args.workers
+        if exporter == "metric_datapoint_export":
+            module.CONCURRENCY = args.concurrency
+            module.FETCH_WINDOW_HOURS = args.fetch_window_hours
+            module.ENGINE = args.engine
+
+        start_ts = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            if exporter == "metric_datapoint_export":
+                summaries = module.main(args.days)
+            else:
+                summaries = module.main()
+        elapsed = time.perf_counter() - start_ts
+
+    rows = sum(summary["rows"] for summary in summaries)
+    peak_rss_kb = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return {
+        "exporter": exporter,
+        "rows": rows,
+        "seconds": elapsed,
+        "rows_per_sec": rows / max(elapsed, 1e-9),
+        "peak_rss_mib": peak_rss_kb / 1024,
+        "requests": fake.request_counts(),
+    }
+
+
+def main(args):
+    exporters = EXPORTERS if args.exporter == "all" else [args.exporter]
+
+    for exporter in exporters:
+        # a fresh process per exporter, so peak RSS is not shared between them
+        output = subprocess.run(
+            [sys.executable, __file__, *sys.argv[1:], "--run", exporter],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        result = json.loads(output.splitlines()[-1])
+
+        requests = result["requests"]
+        print(
+            f"{exporter:>23}: rows={result['rows']}, time={result['seconds']:.2f}s, "
+            f"rows_per_sec={result['rows_per_sec']:.0f}, "
+            f"peak_rss={result['peak_rss_mib']:.1f}MiB, "
+            f"requests={sum(requests.values())}"
+        )
+        print(
+            " " * 25
+            + ", ".join(f"{name}={count}" for name, count in requests.items() if count)
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the export scripts against a fake Lightup API"
+    )
+    parser.add_argument(
+        "--exporter", choices=["all", *EXPORTERS], default="all", help="Exporter"
+    )
+    parser.add_argument("--workspaces", type=int, default=2)
+    parser.add_argument("--metrics", type=int, default=50, help="Per workspace")
+    parser.add_argument("--monitors", type=int, default=1, help="Per metric")
+    parser.add_argument("--slices", type=int, default=10, help="Per metric")
+    parser.add_argument(
+        "--interval", type=int, default=3600, help="Seconds between datapoints"
+    )
+    parser.add_argument("--incidents", type=int, default=2, help="Per monitor")
+    parser.add_argument("--days", type=int, default=7, help="Datapoint lookback")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds per fake request"
+    )
+    parser.add_argument("--format", default="csv", help="Output format")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--fetch-window-hours", type=int)
+    parser.add_argument("--engine", choices=["python", "vectorized"], default="python")
+    # internal, runs a single exporter in this process
+    parser.add_argument("--run", choices=EXPORTERS, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.run:
+        print(json.dumps(run_exporter(args.run, args)))
+    else:
+        main(args)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the python and vectorized join engines of metric_datapoint_export on
+the datapoints, monitor datapoints and incidents of a synthetic metric, no
+Lightup cluster is needed.
+
+Reports the time each engine takes to build all rows of the metric, and
+checks that both engines return the same rows.
+
+See usage: python bench_join_engines.py --help
+"""
+
+import argparse
+import random
+import time
+
+from scripts.benchmarks.fake_lightup import Workload, install
+
+# the exporter creates its lightctl clients at import
+install(Workload())
+
+from scripts.common.incidents import IncidentIndex  # noqa: E402
+from scripts.export import vectorized_join  # noqa: E402
+from scripts.export.datapoint_rows import get_metric_columns  # noqa: E402
+from scripts.export.metric_datapoint_export import iter_metric_rows  # noqa: E402
+
+METRIC = {
+    "metadata": {"uuid": "metric-uuid", "name": "metric", "idSerial": 1},
+    "config": {
+        "dimension": "accuracy",
+        "sources": ["source-uuid"],
+        "table": {"schemaName": "schema", "tableName": "table"},
+        "valueColumns": [{"columnName": "column"}],
+    },
+}
+SOURCE_MAP = {"source-uuid": "source"}
+START_TS = 1700000000
+
+
+def make_metric(num_datapoints: int, num_slices: int, num_monitors: int, seed: int):
+    rng = random.Random(seed)
+    slices = [{"region": f"region-{i}", "env": "prod"} for i in range(num_slices)]
+    datapoints = [
+        {
+            "metricUuid": "metric-uuid",
+            "eventTs": START_TS + (i // num_slices) * 3600,
+            "slice": dict(slices[i % num_slices]),
+            "value": rng.random(),
+            "recordedTs": START_TS + (i // num_slices) * 3600 + 60,
+        }
+        for i in range(num_datapoints)
+    ]
+    end_ts = START_TS + (num_datapoints // num_slices + 1) * 3600
+
+    monitors = []
+    monitor_datapoints_map = {}
+    incidents = []
+    for j in range(num_monitors):
+        monitor_uuid = f"monitor-uuid-{j}"
+        monitors.append({"metadata": {"uuid": monitor_uuid, "name": f"monitor {j}"}})
+        # most datapoints have a monitor datapoint, slightly off their eventTs
+        monitor_datapoints_map[monitor_uuid] = [
+            {
+                "slice": dict(dp["slice"]),
+                "time": dp["eventTs"] + rng.choice([0, 0.0004, -0.0004]),
+                "filtered_obs_val": dp["value"],
+                "lower_exp_limit": 0.1,
+                "upper_exp_limit": 0.9,
+                "filter_uuid": monitor_uuid,
+            }
+            for dp in datapoints
+            if rng.random() < 0.9
+        ]
+        for _ in range(num_slices * 2):
+            start_ts = rng.uniform(START_TS, end_ts)
+            incidents.append(
+                {
+                    "filter_uuid": monitor_uuid,
+                    "slice": dict(rng.choice(slices)),
+                    "start_ts": start_ts,
+                    "end_ts": start_ts + rng.uniform(0, 12 * 3600),
+                }
+            )
+
+    return datapoints, monitors, monitor_datapoints_map, IncidentIndex(incidents)
+
+
+def run(name: str, fn, metric: tuple) -> list:
+    datapoints, monitors, monitor_datapoints_map, incidents = metric
+    metric_columns = get_metric_columns("workspace-uuid", METRIC, SOURCE_MAP)
+
+    start_ts = time.perf_counter()
+    rows = list(
+        fn(datapoints, metric_columns, monitors, monitor_datapoints_map, incidents)
+    )
+    elapsed = time.perf_counter() - start_ts
+
+    print(
+        f"{name:>10}: rows={len(rows)}, time={elapsed:.3f}s, "
+        f"rows_per_sec={len(rows) / max(elapsed, 1e-9):.0f}"
+    )
+    return rows
+
+
+def main(num_datapoints: int, num_slices: int, num_monitors: int, seed: int):
+    metric = make_metric(num_datapoints, num_slices, num_monitors, seed)
+    python_rows = run("python", iter_metric_rows, metric)
+    vectorized_rows = run("vectorized", vectorized_join.iter_metric_rows, metric)
+    if python_rows != vectorized_rows:
+        raise AssertionError("the engines returned different rows")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the datapoint export join engines"
+    )
+    parser.add_argument("--datapoints", type=int, default=100000)
+    parser.add_argument("--slices", type=int, default=10)
+    parser.add_argument("--monitors", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    main(args.datapoints, args.slices, args.monitors, args.seed)
@@ -0,0 +1,274 @@
+"""
+In-process fake Lightup API for benchmarking the export scripts offline.
+
+install() patches the lightctl BaseClient so every client created afterwards
+answers its GET requests from a synthetic Workload instead of a Lightup
+cluster, optionally sleeping `latency` seconds per request to model the
+network. Payloads are generated per request, so the fake holds no datapoints
+in memory and peak RSS reflects the exporter. JSON encoding and decoding of
+the responses is skipped.
+
+Requests are counted per endpoint in shared memory, so requests issued by
+forked worker processes are counted too. install() must run before the
+exporter module is imported, since it creates its clients at import.
+"""
+
+import multiprocessing
+import random
+import re
+import time
+import urllib.parse
+from dataclasses import dataclass
+from math import ceil
+
+from lightctl.client.base_client import BaseClient
+
+URL_BASE = "http://lightup.fake"
+
+ENDPOINTS = [
+    ("workspaces", re.compile(r"^/api/v\d+/workspaces/$")),
+    ("sources", re.compile(r"^/api/v\d+/ws/([^/]+)/sources/$")),
+    ("metrics", re.compile(r"^/api/v\d+/ws/([^/]+)/metrics/$")),
+    ("monitors", re.compile(r"^/api/v\d+/ws/([^/]+)/monitors/$")),
+    (
+        "metric_datapoints",
+        re.compile(r"^/api/v\d+/ws/([^/]+)/metrics/([^/]+)/datapoints$"),
+    ),
+    (
+        "monitor_datapoints",
+        re.compile(r"^/api/v\d+/ws/([^/]+)/monitors/([^/]+)/metrics$"),
+    ),
+    ("incidents", re.compile(r"^/api/v\d+/ws/([^/]+)/incidents/$")),
+]
+
+
+@dataclass
+class Workload:
+    workspaces: int = 2
+    metrics: int = 50
+    monitors_per_metric: int = 1
+    slices: int = 10
+    sources: int = 5
+    # seconds between the datapoints of a slice
+    interval: int = 3600
+    # incidents per monitor over the whole window
+    incidents_per_monitor: int = 2
+    start_ts: float = 0
+    end_ts: float = 0
+    seed: int = 0
+
+
+def workspace_uuid(i: int) -> str:
+    return f"00000000-0000-0000-0000-{i:012d}"
+
+
+def metric_uuid(workspace_id: str, i: int) -> str:
+    return f"{workspace_id[-6:]}-metric-{i}"
+
+
+def monitor_uuid(metric_id: str, i: int) -> str:
+    return f"{metric_id}-monitor-{i}"
+
+
+class FakeLightup:
+    def __init__(self, workload: Workload, latency: float = 0.0):
+        self.workload = workload
+        self.latency = latency
+        self.counts = multiprocessing.Array("q", len(ENDPOINTS))
+
+    def request_counts(self) -> dict:
+        with self.counts.get_lock():
+            return {name: self.counts[i] for i, (name, _) in enumerate(ENDPOINTS)}
+
+    def _slices(self) -> list[dict]:
+        if self.workload.slices <= 1:
+            return [{}]
+        return [
+            {"region": f"region-{i}", "env": "prod"}
+            for i in range(self.workload.slices)
+        ]
+
+    def _metric_ids(self, workspace_id: str) -> list[str]:
+        return [metric_uuid(workspace_id, i) for i in range(self.workload.metrics)]
+
+    def workspaces(self) -> dict:
+        return {
+            "data": [
+                {"uuid": workspace_uuid(i), "name": f"workspace {i}"}
+                for i in range(self.workload.workspaces)
+            ]
+        }
+
+    def sources(self, workspace_id: str) -> list:
+        return [
+            {"metadata": {"uuid": f"source-{i}", "name": f"source {i}"}}
+            for i in range(self.workload.sources)
+        ]
+
+    def metrics(self, workspace_id: str) -> list:
+        w = self.workload
+        return [
+            {
+                "metadata": {
+                    "uuid": metric_id,
+                    "name": f"metric {i}",
+                    "idSerial": i,
+                    "creationType": "manual",
+                    "tags": ["benchmark"],
+                },
+                "config": {
+                    "configType": "metricConfig",
+                    "dimension": "accuracy",
+                    "sources": [f"source-{i % w.sources}"],
+                    "isLive": True,
+                    "table": {
+                        "schemaName": "schema",
+                        "schemaUuid": "schema-uuid",
+                        "tableName": f"table_{i}",
+                        "tableUuid": f"table-uuid-{i}",
+                    },
+                    "valueColumns": [
+                        {"columnName": f"column_{i}", "columnUuid": f"column-{i}"}
+                    ],
+                    "collectionMode": {"type": "scheduled"},
+                },
+                "status": {
+                    "lastSampleTs": w.end_ts,
+                    "configUpdatedTs": w.start_ts,
+                    "runStatus": "ok",
+                },
+            }
+            for i, metric_id in enumerate(self._metric_ids(workspace_id))
+        ]
+
+    def monitors(self, workspace_id: str) -> dict:
+        w = self.workload
+        return {
+            "data": [
+                {
+                    "metadata": {
+                        "uuid": monitor_uuid(metric_id, j),
+                        "name": f"monitor {j}",
+                        "idSerial": j,
+                        "tags": [],
+                        "workspaceId": workspace_id,
+                    },
+                    "config": {"metrics": [metric_id], "isLive": True},
+                    "status": {
+                        "runStatus": "ok",
+                        "lastSampleTs": w.end_ts,
+                        "configUpdatedTs": w.start_ts,
+                    },
+                }
+                for metric_id in self._metric_ids(workspace_id)
+                for j in range(w.monitors_per_metric)
+            ]
+        }
+
+    def _event_times(self, start_ts: float, end_ts: float) -> range:
+        w = self.workload
+        offset = max(start_ts - w.start_ts, 0)
+        first_ts = w.start_ts + ceil(offset / w.interval) * w.interval
+        return range(int(first_ts), int(min(end_ts, w.end_ts)), w.interval)
+
+    def metric_datapoints(
+        self, workspace_id: str, metric_id: str, start_ts: float, end_ts: float
+    ) -> list:
+        rng = random.Random(f"{self.workload.seed}-{metric_id}-{start_ts}")
+        return [
+            {
+                "metricUuid": metric_id,
+                "eventTs": event_ts,
+                "slice": dict(slice_value),
+                "value": rng.random() * 100,
+                "recordedTs": event_ts + 60,
+            }
+            for event_ts in self._event_times(start_ts, end_ts)
+            for slice_value in self._slices()
+        ]
+
+    def monitor_datapoints(
+        self, workspace_id: str, monitor_id: str, start_ts: float, end_ts: float
+    ) -> list:
+        rng = random.Random(f"{self.workload.seed}-{monitor_id}-{start_ts}")
+        return [
+            {
+                "slice": dict(slice_value),
+                "time": event_ts,
+                "filtered_obs_val": rng.random() * 100,
+                "lower_exp_limit": 10.0,
+                "upper_exp_limit": 90.0,
+                "filter_uuid": monitor_id,
+            }
+            for event_ts in self._event_times(start_ts, end_ts)
+            for slice_value in self._slices()
+        ]
+
+    def incidents(self, workspace_id: str, start_ts: float, end_ts: float) -> dict:
+        w = self.workload
+        slices = self._slices()
+        duration = max(w.end_ts - w.start_ts, 1)
+        incidents = []
+        for metric_id in self._metric_ids(workspace_id):
+            for j in range(w.monitors_per_metric):
+                monitor_id = monitor_uuid(metric_id, j)
+                rng = random.Random(f"{w.seed}-{monitor_id}")
+                for k in range(w.incidents_per_monitor):
+                    incident_start_ts = w.start_ts + rng.random() * duration
+                    incident_end_ts = incident_start_ts + rng.random() * 6 * 3600
+                    if incident_end_ts < start_ts or incident_start_ts >= end_ts:
+                        continue
+                    incidents.append(
+                        {
+                            "id": f"{monitor_id}-incident-{k}",
+                            "filter_uuid": monitor_id,
+                            "slice": dict(rng.choice(slices)),
+                            "start_ts": incident_start_ts,
+                            "end_ts": incident_end_ts,
+                        }
+                    )
+        return {"data": incidents}
+
+    def get(self, endpoint: str):
+        url = urllib.parse.urlparse(endpoint)
+        query = {
+            key: float(values[0])
+            for key, values in urllib.parse.parse_qs(url.query).items()
+            if key in ("start_ts", "end_ts")
+        }
+        for i, (name, pattern) in enumerate(ENDPOINTS):
+            match = pattern.match(url.path)
+            if match is None:
+                continue
+
+            with self.counts.get_lock():
+                self.counts[i] += 1
+            if self.latency:
+                time.sleep(self.latency)
+
+            args = match.groups()
+            if name in ("metric_datapoints", "monitor_datapoints", "incidents"):
+                start_ts = query.get("start_ts", self.workload.start_ts)
+                end_ts = query.get("end_ts", self.workload.end_ts)
+                args = (*args, start_ts, end_ts)
+            return getattr(self, name)(*args)
+
+        raise ValueError(f"fake Lightup API has no endpoint {endpoint}")
+
+
+def install(workload: Workload, latency: float = 0.0) -> FakeLightup:
+    """routes the GET requests of all lightctl clients to a FakeLightup"""
+    fake = FakeLightup(workload, latency)
+
+    def init(self):
+        self.credential = {}
+        self.refresh_token = None
+        self.url_base = URL_BASE
+        self.access_token = "fake"
+
+    def get(self, endpoint: str):
+        return fake.get(endpoint)
+
+    BaseClient.__init__ = init
+    BaseClient.get = get
+    return fake
@@ -0,0 +1,4 @@
+"""
+Helpers shared by the scripts in this repo. Import them with the repo root on
+PYTHONPATH (see dev.sh), e.g. `from scripts.common.concurrency import FetchPool`.
+"""
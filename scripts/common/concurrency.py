@@ -0,0 +1,229 @@
+"""
+Concurrency helpers for scripts that issue many Lightup API requests.
+
+The lightctl clients are synchronous, so scripts that issue thousands of
+requests spend most of their time waiting on the network. FetchPool runs those
+requests on a fixed number of threads and keeps simple counters so callers can
+report how many requests are in flight and how fast they complete. With an
+Instrumentation, the latency of each request is also recorded under the name
+of the function it ran.
+
+WritePool is a FetchPool whose requests can be made to wait for the requests
+they depend on, e.g. creating an asset before setting its attributes.
+TokenBucket rate limits calls across threads, an API client takes a token per
+HTTP request it sends so retries and follow up requests are throttled too.
+
+process_map spreads CPU bound per workspace work over a pool of processes.
+"""
+
+import threading
+import time
+from concurrent.futures import (
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
+from typing import Callable, Iterable, Iterator, Optional, Sequence
+
+from scripts.common.instrumentation import Instrumentation
+
+
+class FetchPool:
+    def __init__(
+        self,
+        concurrency: int = 1,
+        report_interval: float = 30.0,
+        log: Optional[Callable] = None,
+        stats: Optional[Instrumentation] = None,
+    ):
+        self.concurrency = max(1, concurrency)
+        self.report_interval = report_interval
+        self.log = log or print
+        self.stats = stats
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix="fetch"
+        )
+        self._lock = threading.Lock()
+
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.start_ts = time.time()
+        self._last_report_ts = self.start_ts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    @property
+    def in_flight(self) -> int:
+        with self._lock:
+            return self.submitted - self.completed
+
+    def _run(self, fn: Callable, args: tuple, kwargs: dict):
+        start_ts = time.time()
+        ok = False
+        try:
+            result = fn(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            latency = time.time() - start_ts
+            with self._lock:
+                self.completed += 1
+                self.failed += not ok
+                self.total_latency += latency
+            if self.stats is not None:
+                self.stats.record_request(
+                    getattr(fn, "__name__", "request"), latency, ok
+                )
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        with self._lock:
+            self.submitted += 1
+        return self._executor.submit(self._run, fn, args, kwargs)
+
+    def status(self) -> str:
+        with self._lock:
+            submitted = self.submitted
+            completed = self.completed
+            failed = self.failed
+            total_latency = self.total_latency
+
+        elapsed = max(time.time() - self.start_ts, 1e-9)
+        avg_latency = total_latency / completed if completed else 0.0
+        return (
+            f"requests: in_flight={submitted - completed}, completed={completed}, "
+            f"failed={failed}, rate={completed / elapsed:.2f}/s, "
+            f"avg_latency={avg_latency:.3f}s, concurrency={self.concurrency}"
+        )
+
+    def maybe_report(self):
+        """log the pool status if report_interval seconds have passed"""
+        now = time.time()
+        if now - self._last_report_ts < self.report_interval:
+            return
+        self._last_report_ts = now
+        self.log(f"- {self.status()}")
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter: acquire() allows `rate` calls per second on
+    average and bursts of up to `burst` calls, blocking the caller until a
+    token is available. a rate of None or 0 does not limit.
+    """
+
+    def __init__(self, rate: Optional[float] = None, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = max(1.0, burst if burst is not None else rate or 1.0)
+        self._tokens = self.burst
+        self._last_ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._last_ts) * self.rate
+                )
+                self._last_ts = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class WritePool(FetchPool):
+    """
+    FetchPool where submit_after runs a request once the futures it depends on
+    completed. dependencies must be submitted to the same pool first, the pool
+    runs requests in submission order so a request never waits on one that
+    has not started.
+    """
+
+    def _run_after(self, after: Sequence[Future], fn: Callable, args, kwargs):
+        try:
+            for future in after:
+                # raises the exception of a failed dependency
+                future.result()
+        except BaseException:
+            with self._lock:
+                self.completed += 1
+                self.failed += 1
+            raise
+        return self._run(fn, args, kwargs)
+
+    def submit_after(
+        self, after: Sequence[Future], fn: Callable, *args, **kwargs
+    ) -> Future:
+        if not after:
+            return self.submit(fn, *args, **kwargs)
+        with self._lock:
+            self.submitted += 1
+        return self._executor.submit(self._run_after, after, fn, args, kwargs)
+
+
+def process_map(
+    fn: Callable,
+    items: Iterable,
+    workers: int = 1,
+    initializer: Optional[Callable] = None,
+    initargs: tuple = (),
+) -> Iterator[tuple]:
+    """
+    yields (item, fn(item)) for each item, spreading the items over a pool of
+    `workers` processes and yielding results as they complete. fn must be
+    picklable and initializer is called once in each worker process, e.g. to
+    create that process's lightctl clients. with a single worker the items are
+    processed in order in the current process and initializer is not called.
+    """
+    if workers <= 1:
+        for item in items:
+            yield item, fn(item)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=initializer, initargs=initargs
+    ) as executor:
+        futures = {executor.submit(fn, item): item for item in items}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def format_workspace_summary(summaries: list[dict], wall_seconds: float) -> str:
+    """
+    aggregates per workspace summaries returned by process_map workers. each
+    summary has the keys workspace, rows, seconds and pid, plus requests when
+    the worker counted its API requests.
+    """
+    rows = sum(summary["rows"] for summary in summaries)
+    busy_seconds = sum(summary["seconds"] for summary in summaries)
+    requests = sum(summary.get("requests", 0) for summary in summaries)
+    workers = len({summary["pid"] for summary in summaries})
+
+    lines = [
+        f"workspaces={len(summaries)}, workers={workers}, rows={rows}, "
+        f"requests={requests}, wall={wall_seconds:.1f}s, "
+        f"workspace_seconds={busy_seconds:.1f}s, "
+        f"rows_per_sec={rows / max(wall_seconds, 1e-9):.1f}"
+    ]
+    if summaries:
+        slowest = max(summaries, key=lambda summary: summary["seconds"])
+        lines.append(
+            f"slowest workspace '{slowest['workspace']}' took "
+            f"{slowest['seconds']:.1f}s for {slowest['rows']} rows"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,58 @@
+"""
+Helpers for Lightup incidents as returned by IncidentClient.list_incidents.
+"""
+
+from bisect import bisect_right
+from collections import defaultdict
+from itertools import accumulate
+from typing import Iterable, Optional
+
+from scripts.common.slices import slice_key
+
+
+class IncidentIndex:
+    """
+    Answers "was this timestamp inside an incident?" for a monitor and slice.
+
+    Incident intervals are grouped per (monitor, slice) and sorted by start_ts,
+    along with the running maximum of end_ts. A timestamp is inside an incident
+    when the largest end_ts among the incidents that started at or before it is
+    not earlier than the timestamp, which takes one bisect per lookup.
+    Overlapping incidents are handled without merging them.
+    """
+
+    def __init__(self, incidents: Iterable[dict]):
+        grouped = defaultdict(list)
+        for incident in incidents:
+            key = (incident.get("filter_uuid"), slice_key(incident.get("slice")))
+            grouped[key].append((incident["start_ts"], incident["end_ts"]))
+
+        self._intervals = {}
+        for key, intervals in grouped.items():
+            intervals.sort()
+            starts = [start_ts for start_ts, _ in intervals]
+            max_ends = list(accumulate((end_ts for _, end_ts in intervals), max))
+            self._intervals[key] = (starts, max_ends)
+
+    def __len__(self):
+        return sum(len(starts) for starts, _ in self._intervals.values())
+
+    def intervals(self, monitor_uuid: str, key: Optional[str]) -> Optional[tuple]:
+        """
+        returns the sorted start_ts and running maximum end_ts lists of the
+        incidents of a monitor and slice_key, None if it has no incidents
+        """
+        return self._intervals.get((monitor_uuid, key))
+
+    def contains(self, monitor_uuid: str, slice_value, ts: float) -> bool:
+        """
+        returns True if ts is within [start_ts, end_ts] of any incident, the
+        slice can be given as a slice dict or its slice_key/SliceKey
+        """
+        entry = self._intervals.get((monitor_uuid, slice_key(slice_value)))
+        if entry is None:
+            return False
+
+        starts, max_ends = entry
+        pos = bisect_right(starts, ts)
+        return pos > 0 and max_ends[pos - 1] >= ts
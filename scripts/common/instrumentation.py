@@ -0,0 +1,190 @@
+"""
+Timing and request instrumentation shared by the export and integration
+scripts.
+
+An Instrumentation collects:
+- spans: total seconds and count per phase, e.g. list_metadata, fetch, join
+  and write
+- requests: count, failures, retries and a latency histogram per endpoint
+- counters, e.g. rows written, the "rows" counter is also reported as
+  rows/sec
+
+Instrumentation is thread safe. Worker processes send their stats back with
+to_dict() and the parent combines them with merge(). summary() formats the
+stats for printing and write_json() saves them to a stats file.
+"""
+
+import json
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from copy import deepcopy
+from typing import Iterator, Optional
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = [
+    0.001,
+    0.002,
+    0.005,
+    0.01,
+    0.02,
+    0.05,
+    0.1,
+    0.2,
+    0.5,
+    1.0,
+    2.0,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    float("inf"),
+]
+
+
+def _new_endpoint() -> dict:
+    return {
+        "count": 0,
+        "failed": 0,
+        "retries": 0,
+        "seconds": 0.0,
+        "max_seconds": 0.0,
+        "buckets": [0] * len(LATENCY_BUCKETS),
+    }
+
+
+def _percentile(buckets: list[int], fraction: float) -> float:
+    """upper bound of the bucket holding the given fraction of requests"""
+    target = fraction * sum(buckets)
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS, buckets):
+        seen += count
+        if count and seen >= target:
+            return bound
+    return 0.0
+
+
+class Instrumentation:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.start_ts = time.time()
+        self.spans = {}
+        self.endpoints = {}
+        self.counters = {}
+
+    def add_span(self, name: str, seconds: float, count: int = 1):
+        with self._lock:
+            span = self.spans.setdefault(name, {"count": 0, "seconds": 0.0})
+            span["count"] += count
+            span["seconds"] += seconds
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        start_ts = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, time.perf_counter() - start_ts)
+
+    def record_request(self, endpoint: str, seconds: float, ok: bool = True):
+        bucket = bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            stats = self.endpoints.setdefault(endpoint, _new_endpoint())
+            stats["count"] += 1
+            stats["failed"] += not ok
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["buckets"][bucket] += 1
+
+    def record_retry(self, endpoint: str):
+        with self._lock:
+            self.endpoints.setdefault(endpoint, _new_endpoint())["retries"] += 1
+
+    @contextmanager
+    def request(self, endpoint: str) -> Iterator[None]:
+        """times a request, which counts as failed if it raises"""
+        start_ts = time.perf_counter()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self.record_request(endpoint, time.perf_counter() - start_ts, ok)
+
+    def count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return deepcopy(
+                {
+                    "start_ts": self.start_ts,
+                    "spans": self.spans,
+                    "endpoints": self.endpoints,
+                    "counters": self.counters,
+                }
+            )
+
+    def merge(self, stats: Optional[dict]):
+        """adds the stats returned by another Instrumentation's to_dict()"""
+        if not stats:
+            return
+        for name, span in stats["spans"].items():
+            self.add_span(name, span["seconds"], span["count"])
+        with self._lock:
+            for endpoint, other in stats["endpoints"].items():
+                merged = self.endpoints.setdefault(endpoint, _new_endpoint())
+                for key in ("count", "failed", "retries", "seconds"):
+                    merged[key] += other[key]
+                merged["max_seconds"] = max(merged["max_seconds"], other["max_seconds"])
+                merged["buckets"] = [
+                    a + b for a, b in zip(merged["buckets"], other["buckets"])
+                ]
+            for name, value in stats["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self) -> str:
+        stats = self.to_dict()
+        wall_seconds = max(time.time() - self.start_ts, 1e-9)
+
+        header = f"wall={wall_seconds:.1f}s"
+        rows = stats["counters"].get("rows")
+        if rows is not None:
+            header += f", rows={rows}, rows_per_sec={rows / wall_seconds:.1f}"
+        lines = [header]
+
+        for name, span in sorted(
+            stats["spans"].items(), key=lambda item: -item[1]["seconds"]
+        ):
+            lines.append(
+                f"- phase {name}: {span['seconds']:.2f}s over {span['count']} spans"
+            )
+
+        for endpoint, endpoint_stats in sorted(stats["endpoints"].items()):
+            count = endpoint_stats["count"]
+            buckets = endpoint_stats["buckets"]
+            lines.append(
+                f"- {endpoint}: requests={count}, "
+                f"failed={endpoint_stats['failed']}, "
+                f"retries={endpoint_stats['retries']}, "
+                f"avg={endpoint_stats['seconds'] / max(count, 1):.3f}s, "
+                f"p50<={_percentile(buckets, 0.5):g}s, "
+                f"p95<={_percentile(buckets, 0.95):g}s, "
+                f"p99<={_percentile(buckets, 0.99):g}s, "
+                f"max={endpoint_stats['max_seconds']:.3f}s"
+            )
+
+        for name, value in sorted(stats["counters"].items()):
+            if name != "rows":
+                lines.append(f"- {name}={value}")
+
+        return "\n".join(lines)
+
+    def write_json(self, file_path: str):
+        stats = self.to_dict()
+        stats["wall_seconds"] = time.time() - self.start_ts
+        stats["latency_buckets"] = [str(bound) for bound in LATENCY_BUCKETS]
+        with open(file_path, "w", encoding="utf-8") as f:
+            json.dump(stats, f, indent=2)
@@ -0,0 +1,198 @@
+"""
+On-disk cache of the per workspace source, metric and monitor listings.
+
+Most scripts start by listing the sources, metrics and monitors of every
+workspace. MetadataCache keeps each listing on local disk, so back to back
+runs and cron jobs reuse it for `ttl` seconds instead of downloading the
+configuration again:
+
+    cache = MetadataCache(namespace=metric_client.url_base)
+    metrics = cache.list("metrics", workspace_id, metric_client.list_metrics)
+
+list_workspace_metadata() does the same and times the listing requests that
+were not served from the cache.
+
+Scripts that update an object write the updated object through with
+cache.update(), which replaces the cached copy unless the cache already holds
+a newer configUpdatedTs, so the cache never goes back to an older
+configuration. cache.invalidate() drops a listing when a script can not tell
+what changed.
+
+The ttl is the only freshness check, a cached listing may miss edits made on
+the server since it was fetched. Scripts that update objects must list them
+from the API, not through the cache, so they never send back a stale
+configuration over a newer one.
+
+Listings are stored per Lightup cluster (namespace) and workspace in
+<cache_dir>/<namespace>/<workspace_id>/<kind>.json. The default ttl is read
+from LIGHTSCRIPT_METADATA_CACHE_TTL, 0 disables the cache.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+from scripts.common.instrumentation import Instrumentation
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".lightup", "lightscript_cache"
+)
+
+KINDS = ["sources", "metrics", "monitors"]
+
+
+def get_default_ttl() -> float:
+    return float(os.environ.get("LIGHTSCRIPT_METADATA_CACHE_TTL", 0))
+
+
+def _uuid(item: dict) -> Optional[str]:
+    return item.get("metadata", {}).get("uuid")
+
+
+def _config_updated_ts(item: dict) -> float:
+    return item.get("status", {}).get("configUpdatedTs") or 0
+
+
+class MetadataCache:
+    def __init__(
+        self,
+        ttl: Optional[float] = None,
+        namespace: str = "default",
+        cache_dir: Optional[str] = None,
+    ):
+        self.ttl = get_default_ttl() if ttl is None else ttl
+        self.cache_dir = os.path.join(
+            cache_dir
+            or os.environ.get("LIGHTSCRIPT_METADATA_CACHE_DIR", DEFAULT_CACHE_DIR),
+            hashlib.sha1(namespace.encode("utf-8")).hexdigest()[:16],
+        )
+        self.hits = 0
+        self.misses = 0
+        # listing requests sent, counted whether or not the cache is enabled
+        self.fetches = 0
+
+        # listings loaded by this process, by (kind, workspace_id)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def _file_path(self, kind: str, workspace_id: str) -> str:
+        if kind not in KINDS:
+            raise ValueError(f"Unsupported metadata kind: {kind}")
+        return os.path.join(self.cache_dir, workspace_id, f"{kind}.json")
+
+    def _load(self, kind: str, workspace_id: str) -> Optional[dict]:
+        entry = self._entries.get((kind, workspace_id))
+        if entry is None:
+            file_path = self._file_path(kind, workspace_id)
+            try:
+                with open(file_path, encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                return None
+        if time.time() - entry["fetchedTs"] > self.ttl:
+            return None
+        return entry
+
+    def _save(self, kind: str, workspace_id: str, entry: dict):
+        self._entries[(kind, workspace_id)] = entry
+
+        file_path = self._file_path(kind, workspace_id)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # unique per process and thread, worker processes may save concurrently
+        tmp_file = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_file, file_path)
+
+    def list(
+        self, kind: str, workspace_id: str, fetch: Callable[[str], list]
+    ) -> list[dict]:
+        """
+        returns the cached listing of kind ("sources", "metrics" or
+        "monitors") for the workspace, calling fetch(workspace_id) when it is
+        missing or older than ttl
+        """
+        with self._lock:
+            if self.enabled:
+                entry = self._load(kind, workspace_id)
+                if entry is not None:
+                    self.hits += 1
+                    self._entries[(kind, workspace_id)] = entry
+                    return entry["items"]
+                self.misses += 1
+            self.fetches += 1
+
+        items = fetch(workspace_id)
+        if not self.enabled:
+            return items
+
+        with self._lock:
+            self._save(kind, workspace_id, {"fetchedTs": time.time(), "items": items})
+        return items
+
+    def update(self, kind: str, workspace_id: str, item: dict):
+        """
+        writes an updated or created object through to the cached listing,
+        unless the cached copy has a newer configUpdatedTs
+        """
+        if not self.enabled or not item:
+            return
+
+        with self._lock:
+            # callers may have modified the listed objects, merge into the
+            # listing saved on disk
+            self._entries.pop((kind, workspace_id), None)
+            entry = self._load(kind, workspace_id)
+            if entry is None:
+                return
+
+            items = entry["items"]
+            uuid = _uuid(item)
+            for i, cached in enumerate(items):
+                if _uuid(cached) != uuid:
+                    continue
+                if _config_updated_ts(cached) > _config_updated_ts(item):
+                    return
+                items[i] = item
+                break
+            else:
+                items.append(item)
+            self._save(kind, workspace_id, entry)
+
+    def invalidate(self, kind: str, workspace_id: str):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._entries.pop((kind, workspace_id), None)
+            try:
+                os.remove(self._file_path(kind, workspace_id))
+            except FileNotFoundError:
+                pass
+
+
+def list_workspace_metadata(
+    cache: MetadataCache,
+    kind: str,
+    workspace_id: str,
+    list_fn: Callable[[str], list],
+    stats: Instrumentation,
+    endpoint_prefix: str = "",
+) -> list[dict]:
+    """
+    lists the workspace sources, metrics or monitors through the cache, the
+    listing requests are recorded in stats as <endpoint_prefix>list_<kind>
+    """
+
+    def fetch(workspace_id: str) -> list[dict]:
+        with stats.request(f"{endpoint_prefix}list_{kind}"):
+            return list_fn(workspace_id)
+
+    return cache.list(kind, workspace_id, fetch)
@@ -0,0 +1,82 @@
+"""
+Helpers for metric slices. Lightup returns a slice as a dict of slice column
+to slice value, `{}` for an unsliced metric.
+
+The canonical form of a slice is its JSON with sorted keys, e.g.
+`{"env": "prod", "region": "us"}`, which is also how exported slices are
+serialized. SliceInterner turns the slices of an export into interned
+SliceKeys, so equal slices share a single key object that is hashed and
+compared as a string.
+"""
+
+import json
+from typing import Optional
+
+
+def slice_key(slice_value) -> Optional[str]:
+    """
+    returns the canonical form of a slice. two slices have the same key
+    exactly when they compare equal, as slice values are strings, so the key
+    can be used in dicts and sets in place of comparing the slice dicts one by
+    one. a SliceKey or a missing slice is returned as is.
+    """
+    if slice_value is None or isinstance(slice_value, SliceKey):
+        return slice_value
+    return json.dumps(slice_value, sort_keys=True, ensure_ascii=False)
+
+
+class SliceKey(str):
+    """
+    An interned slice: the canonical form of the slice, with the slice as a
+    dict with sorted keys in `value`. items() returns the slice items, so a
+    SliceKey can be written wherever a slice dict is expected.
+    """
+
+    value: dict
+
+    def items(self):
+        return self.value.items()
+
+
+class SliceInterner:
+    """
+    Interns slices into SliceKeys. The canonical form is only computed for the
+    first slice of each distinct column order, later slices are looked up by
+    their items.
+    """
+
+    def __init__(self):
+        self._keys = {}
+        self._keys_by_items = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def intern(self, slice_value) -> Optional[SliceKey]:
+        """returns the SliceKey of a slice, None for a missing slice"""
+        if slice_value is None or isinstance(slice_value, SliceKey):
+            return slice_value
+
+        try:
+            items = tuple(slice_value.items())
+            key = self._keys_by_items.get(items)
+        except (AttributeError, TypeError):
+            # not a dict or not hashable, e.g. a list value
+            items = None
+            key = None
+        if key is not None:
+            return key
+
+        text = slice_key(slice_value)
+        key = self._keys.get(text)
+        if key is None:
+            key = SliceKey(text)
+            key.value = (
+                dict(sorted(slice_value.items()))
+                if isinstance(slice_value, dict)
+                else slice_value
+            )
+            self._keys[text] = key
+        if items is not None:
+            self._keys_by_items[items] = key
+        return key
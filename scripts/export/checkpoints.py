@@ -0,0 +1,144 @@
+"""
+Checkpoints for resuming an interrupted datapoint export.
+
+An export writes its checkpoints to `<export_dir>/.checkpoint/`:
+- export.json: the export window and output options of the run, so a resumed
+  run exports the same window in the same format
+- <workspace_uuid>.json: the workspace's completed metrics, with the metric
+  watermark for incremental runs, and the output offset and row count after
+  the last completed metric
+
+A new export creates a new directory with create_export_dir, its checkpoints
+are only read back when the export is resumed. A resumed run skips completed
+workspaces and, for uncompressed and unrotated csv output, truncates the
+workspace file to the checkpoint offset and appends the remaining metrics.
+Other outputs can not be appended to, so an incomplete workspace is exported
+again from the start.
+
+Workspace checkpoint format:
+{"complete": bool, "rows": int, "offset": int | null,
+ "metrics": {"<metric_uuid>": <watermark> | null}, "watermarks": dict | null}
+"""
+
+import json
+import os
+from typing import Optional
+
+from scripts.export.writers import RowWriter
+
+CHECKPOINT_DIRECTORY = ".checkpoint"
+RUN_FILE = "export.json"
+
+
+def _dump(obj, file_path: str):
+    """atomically replaces file_path"""
+    tmp_file = f"{file_path}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(obj, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, file_path)
+
+
+def get_checkpoint_directory(export_dir: str) -> str:
+    return os.path.join(export_dir, CHECKPOINT_DIRECTORY)
+
+
+def create_export_dir(base_dir: str, name: str) -> str:
+    """
+    creates the directory of a new export under base_dir, adding a suffix to
+    name when an export with that name exists, e.g. two exports started in the
+    same second. returns the export directory.
+    """
+    os.makedirs(base_dir, exist_ok=True)
+    export_dir = os.path.join(base_dir, name)
+    suffix = 0
+    while True:
+        try:
+            os.mkdir(export_dir)
+            return export_dir
+        except FileExistsError:
+            suffix += 1
+            export_dir = os.path.join(base_dir, f"{name}_{suffix}")
+
+
+def save_run(export_dir: str, run: dict):
+    checkpoint_dir = get_checkpoint_directory(export_dir)
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    _dump(run, os.path.join(checkpoint_dir, RUN_FILE))
+
+
+def load_run(export_dir: str) -> dict:
+    run_file = os.path.join(get_checkpoint_directory(export_dir), RUN_FILE)
+    if not os.path.exists(run_file):
+        raise ValueError(f"{export_dir} has no checkpoint to resume from")
+    with open(run_file, encoding="utf-8") as f:
+        return json.load(f)
+
+
+class WorkspaceCheckpoint:
+    def __init__(self, export_dir: str, workspace_id: str, resume: bool = False):
+        self.file_path = os.path.join(
+            get_checkpoint_directory(export_dir), f"{workspace_id}.json"
+        )
+        self.state = {
+            "complete": False,
+            "rows": 0,
+            "offset": None,
+            "metrics": {},
+            "watermarks": None,
+        }
+        # a checkpoint left in the directory is only used by a resumed export
+        if resume and os.path.exists(self.file_path):
+            with open(self.file_path, encoding="utf-8") as f:
+                self.state = json.load(f)
+
+        self._writer = None
+        self._resumed_rows = 0
+
+    @property
+    def complete(self) -> bool:
+        return self.state["complete"]
+
+    @property
+    def rows(self) -> int:
+        return self.state["rows"]
+
+    @property
+    def offset(self) -> Optional[int]:
+        """offset to append the remaining metrics at, None to start over"""
+        return self.state["offset"] if self.state["metrics"] else None
+
+    @property
+    def completed_metrics(self) -> dict:
+        """watermark of each completed metric, by metric uuid"""
+        return self.state["metrics"]
+
+    def start(self, writer: RowWriter, resumed: bool):
+        """
+        tracks the rows written by writer. when not resumed from the offset,
+        the completed metrics of a previous run are discarded.
+        """
+        self._writer = writer
+        if not resumed:
+            self.state.update(rows=0, offset=None, metrics={})
+        self._resumed_rows = self.state["rows"]
+
+    def complete_metric(self, metric_uuid: str, watermark: Optional[dict] = None):
+        """
+        records that all rows of the metric are written. only recorded when the
+        writer can be resumed mid file, otherwise the workspace starts over.
+        """
+        offset = self._writer.resume_offset() if self._writer is not None else None
+        if offset is None:
+            return
+
+        self.state["metrics"][metric_uuid] = watermark
+        self.state["rows"] = self._resumed_rows + self._writer.num_rows
+        self.state["offset"] = offset
+        _dump(self.state, self.file_path)
+
+    def complete_workspace(self, watermarks: Optional[dict] = None):
+        """records that the writer is closed with all rows of the workspace"""
+        rows = self._resumed_rows + (self._writer.num_rows if self._writer else 0)
+        self.state.update(complete=True, rows=rows, watermarks=watermarks)
+        _dump(self.state, self.file_path)
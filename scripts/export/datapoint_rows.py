@@ -0,0 +1,161 @@
+"""
+Row model for metric_datapoint_export.
+
+A datapoint row is a DatapointRow, a named tuple of the DATAPOINT_COLUMNS
+values in column order, which takes a fraction of the memory of a dict with
+the same keys and is written by the row writers without key lookups. Missing
+values are None.
+
+The metric columns are computed once per metric and the slice is an interned
+SliceKey, written as the canonical JSON of the slice. A monitor row copies the
+references of the datapoint row and adds the monitor columns, so the slice and
+the other datapoint/metric values are shared between the rows of all
+monitors, and the slice also between all rows of the same slice.
+"""
+
+from math import isnan
+from typing import Any, NamedTuple, Optional
+
+from scripts.common.slices import SliceInterner, SliceKey
+
+# output columns and their types for parquet/arrow output, see writers.py
+DATAPOINT_COLUMNS = [
+    ("workspaceUuid", "category"),
+    ("metricUuid", "category"),
+    ("eventTs", "timestamp"),
+    ("slice", "string_map"),
+    ("value", "float"),
+    ("recordedTs", "timestamp"),
+    ("metricId", "int"),
+    ("metricName", "category"),
+    ("metricDimension", "category"),
+    ("sourceUuid", "category"),
+    ("sourceName", "category"),
+    ("schemaName", "category"),
+    ("tableName", "category"),
+    ("columnName", "category"),
+    ("monitorUuid", "category"),
+    ("monitorName", "category"),
+    ("monitoredValue", "float"),
+    ("monitorLowerBound", "float"),
+    ("monitorUpperBound", "float"),
+    ("incidentExists", "bool"),
+]
+
+# identify a row of a sink table, a re-exported row replaces the existing one
+DATAPOINT_KEY_COLUMNS = ["metricUuid", "eventTs", "slice", "monitorUuid"]
+DATAPOINT_INDEXES = [["metricUuid", "eventTs"], ["monitorUuid"]]
+
+
+class MetricColumns(NamedTuple):
+    workspaceUuid: str
+    metricId: Any
+    metricName: str
+    metricDimension: str
+    sourceUuid: str
+    sourceName: str
+    schemaName: Optional[str]
+    tableName: Optional[str]
+    columnName: str
+
+
+class DatapointRow(NamedTuple):
+    """the values of DATAPOINT_COLUMNS, in the same order"""
+
+    workspaceUuid: Optional[str] = None
+    metricUuid: Optional[str] = None
+    eventTs: Optional[float] = None
+    slice: Optional[SliceKey] = None
+    value: Optional[float] = None
+    recordedTs: Optional[float] = None
+    metricId: Any = None
+    metricName: Optional[str] = None
+    metricDimension: Optional[str] = None
+    sourceUuid: Optional[str] = None
+    sourceName: Optional[str] = None
+    schemaName: Optional[str] = None
+    tableName: Optional[str] = None
+    columnName: Optional[str] = None
+    monitorUuid: Optional[str] = None
+    monitorName: Optional[str] = None
+    monitoredValue: Optional[float] = None
+    monitorLowerBound: Optional[float] = None
+    monitorUpperBound: Optional[float] = None
+    incidentExists: Optional[bool] = None
+
+
+# number of datapoint and metric columns, the monitor columns follow them
+NUM_DATAPOINT_COLUMNS = DatapointRow._fields.index("monitorUuid")
+NO_MONITOR_COLUMNS = (None,) * (len(DatapointRow._fields) - NUM_DATAPOINT_COLUMNS)
+
+# builds a DatapointRow from a tuple of all its values, skipping the generated
+# __new__ of the named tuple which is noticeably slower per row
+_new_row = tuple.__new__
+
+
+def get_metric_columns(
+    workspace_id: str, metric: dict, source_map: dict
+) -> MetricColumns:
+    source_uuid = metric["config"]["sources"][0]
+    table = metric["config"].get("table", {})
+    columns = metric["config"].get("valueColumns")
+    return MetricColumns(
+        workspaceUuid=workspace_id,
+        metricId=metric["metadata"]["idSerial"],
+        metricName=metric["metadata"]["name"],
+        metricDimension=metric["config"]["dimension"],
+        sourceUuid=source_uuid,
+        sourceName=source_map.get(source_uuid, ""),
+        schemaName=table.get("schemaName"),
+        tableName=table.get("tableName"),
+        columnName=columns[0]["columnName"] if columns else "",
+    )
+
+
+def get_datapoint_row(
+    dp: dict, metric_columns: MetricColumns, slices: SliceInterner
+) -> DatapointRow:
+    """returns the row of a datapoint returned by lightctl"""
+    value = dp.get("value")
+    if value is not None and isnan(value):
+        value = None
+    return _new_row(
+        DatapointRow,
+        (
+            metric_columns.workspaceUuid,
+            dp.get("metricUuid"),
+            dp.get("eventTs"),
+            slices.intern(dp.get("slice")),
+            value,
+            dp.get("recordedTs"),
+        )
+        + metric_columns[1:]
+        + NO_MONITOR_COLUMNS,
+    )
+
+
+def get_monitor_row(
+    row: DatapointRow,
+    monitor_uuid: str,
+    monitor_name: str,
+    monitored_value: Optional[float] = None,
+    lower_bound: Optional[float] = None,
+    upper_bound: Optional[float] = None,
+    incident_exists: Optional[bool] = None,
+) -> DatapointRow:
+    """
+    returns the datapoint row with the monitor columns, sharing the values of
+    the datapoint row
+    """
+    return _new_row(
+        DatapointRow,
+        row[:NUM_DATAPOINT_COLUMNS]
+        + (
+            monitor_uuid,
+            monitor_name,
+            monitored_value,
+            lower_bound,
+            upper_bound,
+            incident_exists,
+        ),
+    )
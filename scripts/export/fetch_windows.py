@@ -0,0 +1,75 @@
+"""
+Time windows for fetching long datapoint ranges in several requests.
+
+A metric is first fetched for an initial window. The number of datapoints it
+returns gives the metric's density, and the rest of the range is split into
+windows expected to hold about `target_datapoints` datapoints each, which are
+then fetched concurrently. The windows are stitched back together in window
+order, dropping datapoints returned by both windows of a shared boundary.
+"""
+
+from math import ceil
+from typing import Optional
+
+from scripts.common.slices import slice_key
+
+# adapted windows are whole hours, at least one hour long
+MIN_WINDOW_SECONDS = 3600
+
+
+def plan_windows(
+    start_ts: float, end_ts: float, window_seconds: Optional[float]
+) -> list[tuple]:
+    """splits [start_ts, end_ts) into (start, end) windows of window_seconds"""
+    if not window_seconds or end_ts - start_ts <= window_seconds:
+        return [(start_ts, end_ts)]
+
+    windows = []
+    window_start_ts = start_ts
+    while window_start_ts < end_ts:
+        window_end_ts = min(window_start_ts + window_seconds, end_ts)
+        windows.append((window_start_ts, window_end_ts))
+        window_start_ts = window_end_ts
+    return windows
+
+
+def adapt_window_seconds(
+    num_datapoints: int,
+    window_seconds: float,
+    remaining_seconds: float,
+    target_datapoints: int,
+) -> float:
+    """
+    returns the window size expected to hold target_datapoints, given that a
+    window_seconds window held num_datapoints. an empty window suggests a
+    sparse metric, so the remaining range is fetched at once.
+    """
+    if num_datapoints == 0:
+        return remaining_seconds
+
+    seconds = window_seconds * target_datapoints / num_datapoints
+    seconds = ceil(seconds / MIN_WINDOW_SECONDS) * MIN_WINDOW_SECONDS
+    return min(max(seconds, MIN_WINDOW_SECONDS), remaining_seconds)
+
+
+def stitch_windows(windows: list[Optional[list]], ts_field: str) -> list[dict]:
+    """
+    concatenates the datapoints of consecutive windows. a datapoint with the
+    same timestamp and slice as one in the previous window was returned for
+    both sides of their boundary and is dropped.
+    """
+    if len(windows) == 1:
+        return windows[0] or []
+
+    stitched = []
+    previous_keys = set()
+    for window in windows:
+        keys = set()
+        for dp in window or []:
+            key = (dp[ts_field], slice_key(dp["slice"]))
+            if key in previous_keys:
+                continue
+            keys.add(key)
+            stitched.append(dp)
+        previous_keys = keys
+    return stitched
@@ -6,18 +6,51 @@ including monitor runs if available. Depends on lightctl, if the dependencies
 for this repo are met, this script will run.
 
 Export metrics for each workspace in the following path:
-path/<export_epoch_time>/<workspace_uuid>_datapoints.csv
+path/<export_epoch_time>/<workspace_uuid>_datapoints.<csv|parquet|arrows>
+
+Use --compression to gzip/zstd compress the output while streaming and
+--max-rows-per-file/--max-bytes-per-file to rotate it into numbered parts
+path/<export_epoch_time>/<workspace_uuid>_datapoints.part-<n>.<extension> listed in
+path/<export_epoch_time>/<workspace_uuid>_datapoints.manifest.json.
+
+Use --incremental to only export the datapoints added since the previous
+incremental run, tracked per metric in a watermark state file.
+
+Use --concurrency to overlap the per metric and per monitor requests, rows are
+still written in metric order. The in flight requests and throughput of each
+workspace are printed every 30s and when it completes. Use --fetch-window-hours
+to split long ranges into concurrently fetched windows sized to the metric's
+datapoint density.
+
+Use --sink sqlite:///<path>.db to upsert the rows into the datapoints table of
+a SQLite database instead, indexed by (metricUuid, eventTs) and monitorUuid.
+Re-exported rows replace the existing ones.
+
+Use --engine vectorized to join the monitor datapoints and incidents of each
+metric with numpy instead of row by row, the rows are the same.
+
+Every export checkpoints its progress in path/<export_epoch_time>/.checkpoint/,
+exports started in the same second get a _<n> suffix.
+Use --resume path/<export_epoch_time> to continue an interrupted export, the
+completed workspaces and metrics are skipped, see checkpoints.py.
+
+Use --metadata-cache-ttl to reuse the source, metric and monitor listings of
+runs in the last n seconds, see metadata_cache.py. The ttl is the only
+freshness check, configuration changed within it is exported as cached.
 
 See usage: python metric_export.py --help
 """
 
 import argparse
-import csv
 import os
+import threading
 import time
-from collections import defaultdict
-from copy import deepcopy
-from math import isnan
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from functools import partial
+from itertools import chain
+from math import floor
+from typing import Callable, Iterable, Iterator, Optional
 
 import arrow
 from lightctl.client.datapoint_client import DatapointClient
@@ -27,67 +60,175 @@ from lightctl.client.monitor_client import MonitorClient
 from lightctl.client.source_client import SourceClient
 from lightctl.client.workspace_client import WorkspaceClient
 
-workspace_client = WorkspaceClient()
-source_client = SourceClient()
-metric_client = MetricClient()
-datapoint_client = DatapointClient()
-monitor_client = MonitorClient()
-incident_client = IncidentClient()
+from scripts.common.concurrency import FetchPool, format_workspace_summary, process_map
+from scripts.common.incidents import IncidentIndex
+from scripts.common.instrumentation import Instrumentation
+from scripts.common.metadata_cache import MetadataCache, list_workspace_metadata
+from scripts.common.slices import SliceInterner, slice_key
+from scripts.export.checkpoints import (
+    WorkspaceCheckpoint,
+    create_export_dir,
+    load_run,
+    save_run,
+)
+from scripts.export.datapoint_rows import (
+    DATAPOINT_COLUMNS,
+    DATAPOINT_INDEXES,
+    DATAPOINT_KEY_COLUMNS,
+    DatapointRow,
+    MetricColumns,
+    get_datapoint_row,
+    get_metric_columns,
+    get_monitor_row,
+)
+from scripts.export.fetch_windows import (
+    adapt_window_seconds,
+    plan_windows,
+    stitch_windows,
+)
+from scripts.export.watermarks import WatermarkState
+from scripts.export.writers import (
+    add_writer_arguments,
+    open_row_writer,
+    open_sink_writer,
+)
+
+
+def init_clients():
+    global workspace_client, source_client, metric_client
+    global datapoint_client, monitor_client, incident_client
+
+    workspace_client = WorkspaceClient()
+    source_client = SourceClient()
+    metric_client = MetricClient()
+    datapoint_client = DatapointClient()
+    monitor_client = MonitorClient()
+    incident_client = IncidentClient()
+
+
+init_clients()
 
 # update to appropriate path
 EXPORT_DIRECTORY_PATH = "/tmp/lightupexport/"
 
 DEBUG = False
 
+# number of concurrent datapoint/incident requests, 1 fetches serially
+CONCURRENCY = 1
+
+# datapoints of ranges longer than this many hours are fetched in windows,
+# None fetches each metric in a single request, see fetch_windows.py
+FETCH_WINDOW_HOURS = None
+
+# windows after the first are sized to hold about this many datapoints
+TARGET_WINDOW_DATAPOINTS = 50_000
+
+# incidents are fetched for the whole workspace in windows of this many days
+INCIDENT_CHUNK_DAYS = 7
+
+# joins the monitor datapoints and incidents row by row ("python") or per
+# metric with numpy ("vectorized"), see vectorized_join.py
+ENGINES = ["python", "vectorized"]
+ENGINE = "python"
+
+# one of writers.FORMATS
+EXPORT_FORMAT = "csv"
+
+# output compression and rotation, see writers.open_row_writer
+COMPRESSION = None
+COMPRESSION_LEVEL = None
+MAX_ROWS_PER_FILE = None
+MAX_BYTES_PER_FILE = None
+
+# e.g. sqlite:///<path>, writes the rows to a database instead of files
+SINK = None
+
+# watermark state file, when set only datapoints newer than the previous run
+# are exported, see watermarks.py
+INCREMENTAL_STATE_FILE = None
+
+# seconds before the watermark re-read by incremental runs for late datapoints
+REREAD_WINDOW = 3600
+
+# number of worker processes, workspaces are spread across the workers
+WORKERS = 1
+
+# json file for the phase timings and request latencies of the export
+STATS_FILE = None
+
+# instrumentation of the workspace being exported, see instrumentation.py
+stats = Instrumentation()
+
+# seconds the workspace listings are reused from the local metadata cache,
+# None reads LIGHTSCRIPT_METADATA_CACHE_TTL and 0 disables the cache
+METADATA_CACHE_TTL = None
+
+# cache of the workspace being exported, see metadata_cache.py
+metadata_cache = MetadataCache(0)
+
 
 def dprint(*args):
     if DEBUG:
         print(*args)
 
 
-def export_to_csv(workspace_id, datapoints, start_time):
-    start_ts = time.time()
-
-    path = EXPORT_DIRECTORY_PATH.rstrip("/") + f"/{start_time}"
-
-    csv_file = f"{path}/{workspace_id}_datapoints.csv"
-    csv_columns = [
-        "workspaceUuid",
-        "metricUuid",
-        "eventTs",
-        "slice",
-        "value",
-        "recordedTs",
-        "metricId",
-        "metricName",
-        "metricDimension",
-        "sourceUuid",
-        "sourceName",
-        "schemaName",
-        "tableName",
-        "columnName",
-        "monitorUuid",
-        "monitorName",
-        "monitoredValue",
-        "monitorLowerBound",
-        "monitorUpperBound",
-        "incidentExists",
-    ]
-
-    if not os.path.exists(path):
-        os.makedirs(path)
-
+def export_datapoints(
+    workspace_id,
+    datapoints: Iterable[DatapointRow],
+    path: str,
+    checkpoint: Optional[WorkspaceCheckpoint] = None,
+) -> int:
+    """
+    writes the datapoint rows of a workspace to path. with a checkpoint the
+    file is appended to from the checkpoint offset when it has one.
+    """
+    # workers may create the export directory concurrently
+    os.makedirs(path, exist_ok=True)
+
+    append_offset = None
+    if checkpoint is not None and checkpoint.offset is not None:
+        append_offset = checkpoint.offset
+
+    num_rows = 0
     try:
-        with open(csv_file, "w", encoding="utf-8") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=csv_columns)
-            writer.writeheader()
-            for data in datapoints:
-                writer.writerow(data)
-    except OSError:
-        print("I/O error {ex}")
+        if SINK:
+            writer = open_sink_writer(
+                SINK,
+                "datapoints",
+                DATAPOINT_COLUMNS,
+                DATAPOINT_KEY_COLUMNS,
+                DATAPOINT_INDEXES,
+            )
+        else:
+            writer = open_row_writer(
+                EXPORT_FORMAT,
+                f"{path}/{workspace_id}_datapoints",
+                DATAPOINT_COLUMNS,
+                COMPRESSION,
+                COMPRESSION_LEVEL,
+                MAX_ROWS_PER_FILE,
+                MAX_BYTES_PER_FILE,
+                append_offset,
+            )
+    except OSError as ex:
+        print(f"I/O error {ex}")
         raise
 
-    dprint(f"write to {csv_file} completed in {time.time() - start_ts} seconds")
+    # the datapoints are fetched while they are written, only writer errors
+    # are reported here, fetch errors propagate as they are
+    with writer:
+        if checkpoint is not None:
+            checkpoint.start(writer, resumed=append_offset is not None)
+        for data in datapoints:
+            try:
+                writer.write(data)
+            except OSError as ex:
+                print(f"I/O error {ex}")
+                raise
+            num_rows += 1
+
+    dprint(f"wrote {num_rows} rows to {writer.file_path}")
+    return num_rows
 
 
 def get_event_ts_interval(datapoints: list):
@@ -99,41 +240,348 @@ def get_event_ts_interval(datapoints: list):
     return cur_min, cur_max
 
 
-def add_incident_data(dp: dict, incidents: list, monitor_uuid: str) -> dict:
-    dp["incidentExists"] = False
-    for incident in incidents:
-        if incident.get("filter_uuid") != monitor_uuid:
-            continue
-        if incident.get("slice") != dp["slice"]:
-            continue
-        if incident["start_ts"] <= dp["eventTs"] <= incident["end_ts"]:
-            dp["incidentExists"] = True
-    return dp
+class FilterStatsIndex:
+    """
+    Monitor datapoints (filter stats) indexed by slice key and timestamp
+    bucket. Buckets are `precision` wide, so a datapoint within precision of a
+    stat is always in the stat's bucket or one of its two neighbours.
+    """
+
+    def __init__(
+        self, filter_stats: list, slices: SliceInterner, precision: float = 0.001
+    ):
+        self.precision = precision
+        self._index = defaultdict(list)
+        for pos, stat in enumerate(filter_stats):
+            bucket = floor(stat["time"] / precision)
+            self._index[(slices.intern(stat["slice"]), bucket)].append((pos, stat))
+
+    def lookup(self, slice_value, event_ts: float) -> Optional[dict]:
+        """
+        returns the stat for the slice, a SliceKey or a slice dict, within
+        precision of event_ts. if several stats match, the last one in
+        filter_stats order wins.
+        """
+        key = slice_key(slice_value)
+        bucket = floor(event_ts / self.precision)
+
+        match_pos = -1
+        match = None
+        for b in (bucket - 1, bucket, bucket + 1):
+            for pos, stat in self._index.get((key, b), ()):
+                if pos > match_pos and abs(event_ts - stat["time"]) < self.precision:
+                    match_pos = pos
+                    match = stat
+        return match
 
 
 def join_datapoint_with_filter_stats(
-    dp: dict, filter_stats: list, incidents: list, precision: float = 0.001
-) -> dict:
-    for stat in filter_stats:
-        if stat["slice"] != dp["slice"]:
+    row: DatapointRow,
+    monitor_uuid: str,
+    monitor_name: str,
+    filter_stats: FilterStatsIndex,
+    incidents: IncidentIndex,
+) -> DatapointRow:
+    """returns the monitor row of the datapoint row"""
+    stat = filter_stats.lookup(row.slice, row.eventTs)
+    if stat is None:
+        return get_monitor_row(row, monitor_uuid, monitor_name)
+    return get_monitor_row(
+        row,
+        monitor_uuid,
+        monitor_name,
+        stat["filtered_obs_val"],
+        stat["lower_exp_limit"],
+        stat["upper_exp_limit"],
+        incidents.contains(stat["filter_uuid"], row.slice, row.eventTs),
+    )
+
+
+def iter_metric_rows(
+    datapoints: list[dict],
+    metric_columns: MetricColumns,
+    monitors: list[dict],
+    monitor_datapoints_map: dict,
+    incidents: IncidentIndex,
+) -> Iterator[DatapointRow]:
+    """
+    yields the rows of a metric, one row per datapoint and monitor, or a
+    single row per datapoint when the metric has no monitors. the slices of
+    the metric are interned, joins look them up by SliceKey.
+    """
+    slices = SliceInterner()
+    monitor_stats_index_map = {
+        monitor_uuid: FilterStatsIndex(monitor_datapoints, slices)
+        for monitor_uuid, monitor_datapoints in monitor_datapoints_map.items()
+    }
+
+    for dp in datapoints:
+        row = get_datapoint_row(dp, metric_columns, slices)
+
+        if not monitors:
+            yield row
             continue
 
-        if abs(dp["eventTs"] - stat["time"]) < precision:
-            dp["monitoredValue"] = stat["filtered_obs_val"]
-            dp["monitorLowerBound"] = stat["lower_exp_limit"]
-            dp["monitorUpperBound"] = stat["upper_exp_limit"]
-            dp = add_incident_data(dp, incidents, stat["filter_uuid"])
-    return dp
+        for monitor in monitors:
+            monitor_uuid = monitor["metadata"]["uuid"]
+            yield join_datapoint_with_filter_stats(
+                row,
+                monitor_uuid,
+                monitor["metadata"]["name"],
+                monitor_stats_index_map[monitor_uuid],
+                incidents,
+            )
+
 
+def get_engine() -> Callable[..., Iterator[DatapointRow]]:
+    """returns the iter_metric_rows function of ENGINE"""
+    if ENGINE == "python":
+        return iter_metric_rows
+    if ENGINE != "vectorized":
+        raise ValueError(f"Unsupported engine: {ENGINE}")
 
-def get_workspace_datapoints(ws: dict, start_ts: float, end_ts: float) -> list[dict]:
-    workspace_datapoints = []
+    try:
+        from scripts.export import vectorized_join
+    except ImportError as ex:
+        raise RuntimeError(
+            "the vectorized engine requires numpy, run: pip install numpy"
+        ) from ex
+    return vectorized_join.iter_metric_rows
+
+
+class MetricFetch:
+    """
+    In flight requests for a single metric. The monitor datapoint requests are
+    only issued once the metric has returned datapoints.
+
+    With FETCH_WINDOW_HOURS set, a range longer than the window is fetched in
+    windows: the first window is fetched on its own, the rest of the range is
+    split into windows adapted to the metric's density and fetched
+    concurrently. The monitor datapoints are fetched in the same windows.
+    """
+
+    def __init__(
+        self,
+        pool: FetchPool,
+        workspace_id: str,
+        metric: dict,
+        monitors: list,
+        start_ts: float,
+        end_ts: float,
+    ):
+        self.metric = metric
+        self.monitors = monitors
+        self.workspace_id = workspace_id
+        self.start_ts = start_ts
+        self.end_ts = end_ts
+
+        self._pool = pool
+        self._lock = threading.Lock()
+        first_end_ts = end_ts
+        if FETCH_WINDOW_HOURS:
+            first_end_ts = min(start_ts + FETCH_WINDOW_HOURS * 3600, end_ts)
+        self._windows = [(start_ts, first_end_ts)]
+        self._datapoint_futures = []
+        self._pending_windows = 0
+        self._monitor_futures = {}
+        self._monitors_submitted = threading.Event()
+
+        first_future = self._submit_datapoints(*self._windows[0])
+        first_future.add_done_callback(self._submit_remaining_windows)
+
+    def _submit_datapoints(self, start_ts: float, end_ts: float) -> Future:
+        future = self._pool.submit(
+            datapoint_client.get_metric_datapoints,
+            self.workspace_id,
+            self.metric["metadata"]["uuid"],
+            start_ts,
+            end_ts,
+        )
+        self._datapoint_futures.append(future)
+        return future
+
+    def _submit_remaining_windows(self, future):
+        try:
+            first_end_ts = self._windows[0][1]
+            if future.exception() is not None or first_end_ts >= self.end_ts:
+                self._submit_monitor_fetches()
+                return
+
+            window_seconds = adapt_window_seconds(
+                len(future.result() or []),
+                first_end_ts - self.start_ts,
+                self.end_ts - first_end_ts,
+                TARGET_WINDOW_DATAPOINTS,
+            )
+            windows = plan_windows(first_end_ts, self.end_ts, window_seconds)
+            self._windows.extend(windows)
+            self._pending_windows = len(windows)
+
+            futures = [self._submit_datapoints(*window) for window in windows]
+            for window_future in futures:
+                window_future.add_done_callback(self._complete_window)
+        except BaseException:
+            self._monitors_submitted.set()
+            raise
+
+    def _complete_window(self, future):
+        with self._lock:
+            self._pending_windows -= 1
+            if self._pending_windows:
+                return
+        self._submit_monitor_fetches()
+
+    def _submit_monitor_fetches(self):
+        try:
+            for future in self._datapoint_futures:
+                if future.exception() is not None:
+                    return
+            if not any(future.result() for future in self._datapoint_futures):
+                return
+
+            for monitor in self.monitors:
+                monitor_uuid = monitor["metadata"]["uuid"]
+                self._monitor_futures[monitor_uuid] = [
+                    self._pool.submit(
+                        datapoint_client.get_monitor_datapoints,
+                        self.workspace_id,
+                        monitor_uuid,
+                        window_start_ts,
+                        window_end_ts,
+                    )
+                    for window_start_ts, window_end_ts in self._windows
+                ]
+        finally:
+            self._monitors_submitted.set()
+
+    def result(self) -> tuple[list, dict]:
+        """
+        blocks until all requests for the metric complete, returns datapoints
+        and monitor datapoints per monitor
+        """
+        self._monitors_submitted.wait()
+        datapoints = stitch_windows(
+            [future.result() for future in self._datapoint_futures], "eventTs"
+        )
 
+        monitor_datapoints_map = {
+            monitor_uuid: stitch_windows(
+                [future.result() for future in futures], "time"
+            )
+            for monitor_uuid, futures in self._monitor_futures.items()
+        }
+
+        return datapoints, monitor_datapoints_map
+
+
+def submit_incident_fetches(
+    pool: FetchPool, workspace_id: str, start_ts: float, end_ts: float
+) -> list[Future]:
+    """
+    requests the incidents of all monitors in the workspace, one request per
+    INCIDENT_CHUNK_DAYS window. an incident spanning several windows is
+    returned for each of them, which does not change incident membership.
+    """
+    futures = []
+    chunk_start_ts = start_ts
+    while chunk_start_ts < end_ts:
+        chunk_end_ts = min(chunk_start_ts + INCIDENT_CHUNK_DAYS * 86400, end_ts)
+        futures.append(
+            pool.submit(
+                incident_client.list_incidents,
+                workspace_id,
+                chunk_start_ts,
+                chunk_end_ts,
+            )
+        )
+        chunk_start_ts = chunk_end_ts
+    return futures
+
+
+def iter_metric_fetches(
+    pool: FetchPool,
+    workspace_id: str,
+    metrics: list,
+    metric_to_monitor_map: dict,
+    start_ts: float,
+    end_ts: float,
+    watermarks: Optional[WatermarkState] = None,
+):
+    """
+    yields a MetricFetch per metric in metric order, keeping at most
+    pool.concurrency metrics in flight so results are consumed in a
+    deterministic order with bounded memory. with watermarks, each metric is
+    only fetched from its re-read window onwards.
+    """
+    pending = deque()
+    metrics = iter(metrics)
+
+    while True:
+        while len(pending) < pool.concurrency:
+            metric = next(metrics, None)
+            if metric is None:
+                break
+
+            metric_uuid = metric["metadata"]["uuid"]
+            metric_start_ts = start_ts
+            if watermarks is not None:
+                metric_start_ts = watermarks.get_fetch_start_ts(
+                    workspace_id, metric_uuid, start_ts
+                )
+
+            pending.append(
+                MetricFetch(
+                    pool,
+                    workspace_id,
+                    metric,
+                    metric_to_monitor_map.get(metric_uuid, []),
+                    metric_start_ts,
+                    end_ts,
+                )
+            )
+
+        if not pending:
+            return
+
+        yield pending.popleft()
+        pool.maybe_report()
+
+
+def iter_workspace_datapoints(
+    ws: dict,
+    start_ts: float,
+    end_ts: float,
+    pool: FetchPool,
+    watermarks: Optional[WatermarkState] = None,
+    checkpoint: Optional[WorkspaceCheckpoint] = None,
+) -> Iterator[DatapointRow]:
+    """
+    yields the annotated datapoint rows of a workspace one metric at a time so
+    only the metrics in flight are held in memory. with watermarks, only the
+    datapoints newer than the metric watermark are yielded. with a checkpoint,
+    the completed metrics are skipped and each metric is recorded once all of
+    its rows are consumed.
+
+    the rows are written while the generator waits at yield, that time is
+    recorded as the write phase and the rest of the row processing as join.
+    """
     workspace_id = ws["uuid"]
+    iter_rows = get_engine()
 
-    metrics = metric_client.list_metrics(workspace_id)
-    monitors = monitor_client.list_monitors(workspace_id)
-    sources = source_client.list_sources(workspace_id)
+    with stats.span("list_metadata"):
+        metrics = list_workspace_metadata(
+            metadata_cache, "metrics", workspace_id, metric_client.list_metrics, stats
+        )
+        monitors = list_workspace_metadata(
+            metadata_cache,
+            "monitors",
+            workspace_id,
+            monitor_client.list_monitors,
+            stats,
+        )
+        sources = list_workspace_metadata(
+            metadata_cache, "sources", workspace_id, source_client.list_sources, stats
+        )
 
     dprint(f"- {len(sources)=}, {len(metrics)=}, {len(monitors)=}")
 
@@ -148,131 +596,366 @@ def get_workspace_datapoints(ws: dict, start_ts: float, end_ts: float) -> list[d
         metric_to_monitor_map[metric_uuid].append(monitor)
         monitor_map[monitor["metadata"]["uuid"]] = monitor
 
-    for metric in metrics:
-        # skip compare metrics
-        if metric["config"]["configType"] not in [
-            "metricConfig",
-            "fullTableMetricConfig",
-        ]:
-            continue
+    # skip compare metrics
+    metrics = [
+        metric
+        for metric in metrics
+        if metric["config"]["configType"] in ["metricConfig", "fullTableMetricConfig"]
+    ]
 
+    if checkpoint is not None and checkpoint.completed_metrics:
+        dprint(f"- resuming after {len(checkpoint.completed_metrics)} metrics")
+        metrics = [
+            metric
+            for metric in metrics
+            if metric["metadata"]["uuid"] not in checkpoint.completed_metrics
+        ]
+
+    incident_futures = submit_incident_fetches(pool, workspace_id, start_ts, end_ts)
+    incident_index = None
+
+    for fetch in iter_metric_fetches(
+        pool,
+        workspace_id,
+        metrics,
+        metric_to_monitor_map,
+        start_ts,
+        end_ts,
+        watermarks,
+    ):
+        metric = fetch.metric
         metric_uuid = metric["metadata"]["uuid"]
-        datapoints = datapoint_client.get_metric_datapoints(
-            workspace_id, metric_uuid, start_ts, end_ts
-        )
+        with stats.span("fetch_datapoints"):
+            datapoints, monitor_datapoints_map = fetch.result()
+
+        if watermarks is not None and datapoints:
+            datapoints = watermarks.filter_new(workspace_id, metric_uuid, datapoints)
 
         if not datapoints:
+            if checkpoint is not None:
+                checkpoint.complete_metric(
+                    metric_uuid,
+                    watermarks.get(workspace_id, metric_uuid) if watermarks else None,
+                )
             continue
 
         dprint(f"- processing metric {metric['metadata']['name']} - {len(datapoints)=}")
 
-        monitor_datapoints_map = {}
-        monitor_incidents_map = {}
-
-        for monitor in metric_to_monitor_map.get(metric_uuid, []):
-            monitor_uuid = monitor["metadata"]["uuid"]
-            monitor_datapoints = datapoint_client.get_monitor_datapoints(
-                workspace_id, monitor_uuid, start_ts, end_ts
+        if incident_index is None:
+            with stats.span("fetch_incidents"):
+                incident_index = IncidentIndex(
+                    chain.from_iterable(
+                        future.result() or [] for future in incident_futures
+                    )
+                )
+            dprint(f"- {len(incident_index)=}")
+
+        join_start_ts = time.perf_counter()
+        write_seconds = 0.0
+
+        for row in iter_rows(
+            datapoints,
+            get_metric_columns(workspace_id, metric, source_map),
+            metric_to_monitor_map.get(metric_uuid, []),
+            monitor_datapoints_map,
+            incident_index,
+        ):
+            yield_ts = time.perf_counter()
+            yield row
+            write_seconds += time.perf_counter() - yield_ts
+
+        stats.add_span("join", time.perf_counter() - join_start_ts - write_seconds)
+        stats.add_span("write", write_seconds)
+
+        # the writer has consumed every row of the metric at this point
+        if checkpoint is not None:
+            checkpoint.complete_metric(
+                metric_uuid,
+                watermarks.get(workspace_id, metric_uuid) if watermarks else None,
             )
-            monitor_datapoints_map[monitor_uuid] = []
-            if monitor_datapoints:
-                monitor_datapoints_map[monitor_uuid] = monitor_datapoints
 
-            monitor_incidents_map[monitor_uuid] = []
-            monitor_incidents = incident_client.list_incidents(
-                workspace_id, start_ts, end_ts, monitor_id=monitor_uuid
-            )
-            if monitor_incidents:
-                monitor_incidents_map[monitor_uuid] = monitor_incidents
-
-        # annotate datapoint
-        for dp in datapoints:
-            if dp.get("value") is not None and isnan(dp["value"]):
-                dp["value"] = None
-            dp["workspaceUuid"] = workspace_id
-            dp["metricName"] = metric["metadata"]["name"]
-            dp["metricId"] = metric["metadata"]["idSerial"]
-            dp["metricDimension"] = metric["config"]["dimension"]
-            dp["sourceUuid"] = metric["config"]["sources"][0]
-            dp["sourceName"] = source_map.get(dp["sourceUuid"], "")
-            dp["schemaName"] = metric["config"].get("table", {}).get("schemaName")
-            dp["tableName"] = metric["config"].get("table", {}).get("tableName")
-            if columns := metric["config"].get("valueColumns"):
-                dp["columnName"] = columns[0]["columnName"]
-            else:
-                dp["columnName"] = ""
-
-            if metric_monitors := metric_to_monitor_map.get(metric_uuid):
-                # for each monitor, add a duplicate row if the monitor has processed the datapoint
-                for monitor in metric_monitors:
-                    monitor_dp = deepcopy(dp)
-                    monitor_dp["monitorUuid"] = monitor_uuid = monitor["metadata"][
-                        "uuid"
-                    ]
-                    monitor_dp["monitorName"] = monitor["metadata"]["name"]
-                    join_datapoint_with_filter_stats(
-                        monitor_dp,
-                        monitor_datapoints_map[monitor_uuid],
-                        monitor_incidents_map[monitor_uuid],
-                    )
-                    workspace_datapoints.append(monitor_dp)
-            else:
-                # append datapoint even if there are no monitors
-                workspace_datapoints.append(dp)
 
-    return workspace_datapoints
+def get_settings() -> dict:
+    return {
+        "DEBUG": DEBUG,
+        "EXPORT_DIRECTORY_PATH": EXPORT_DIRECTORY_PATH,
+        "CONCURRENCY": CONCURRENCY,
+        "FETCH_WINDOW_HOURS": FETCH_WINDOW_HOURS,
+        "TARGET_WINDOW_DATAPOINTS": TARGET_WINDOW_DATAPOINTS,
+        "ENGINE": ENGINE,
+        "EXPORT_FORMAT": EXPORT_FORMAT,
+        "COMPRESSION": COMPRESSION,
+        "COMPRESSION_LEVEL": COMPRESSION_LEVEL,
+        "MAX_ROWS_PER_FILE": MAX_ROWS_PER_FILE,
+        "MAX_BYTES_PER_FILE": MAX_BYTES_PER_FILE,
+        "SINK": SINK,
+        "INCREMENTAL_STATE_FILE": INCREMENTAL_STATE_FILE,
+        "REREAD_WINDOW": REREAD_WINDOW,
+        "STATS_FILE": STATS_FILE,
+        "METADATA_CACHE_TTL": METADATA_CACHE_TTL,
+    }
 
 
-def main(num_days: int = 1):
-    main_start_ts = time.time()
+def init_worker(settings: dict):
+    """process pool initializer, applies the settings and creates new clients"""
+    globals().update(settings)
+    init_clients()
 
-    end_ts = arrow.utcnow().floor("day")
-    start_ts = end_ts.shift(days=-num_days).timestamp()
-    end_ts = end_ts.timestamp()
 
-    dprint(
-        f"start_ts={arrow.get(start_ts).format()}, end_ts={arrow.get(end_ts).format()}"
-    )
+def export_workspace(
+    ws: dict, start_ts: float, end_ts: float, export_dir: str, resume: bool = False
+) -> dict:
+    """
+    exports the datapoints of a single workspace to export_dir, runs in a
+    worker process when WORKERS > 1. when resuming, a workspace completed by
+    the interrupted run into export_dir is skipped. returns a summary along
+    with the workspace watermarks and stats.
+    """
+    global stats, metadata_cache
+    stats = Instrumentation()
+    metadata_cache = MetadataCache(METADATA_CACHE_TTL, metric_client.url_base)
+    ws_start_ts = time.time()
+
+    checkpoint = WorkspaceCheckpoint(export_dir, ws["uuid"], resume)
+    if checkpoint.complete:
+        dprint(f"skipping completed workspace {ws['name']}")
+        return {
+            "workspace": ws["name"],
+            "rows": checkpoint.rows,
+            "seconds": 0.0,
+            "requests": 0,
+            "pid": os.getpid(),
+            "watermarks": checkpoint.state["watermarks"],
+        }
+
+    watermarks = None
+    if INCREMENTAL_STATE_FILE:
+        watermarks = WatermarkState(INCREMENTAL_STATE_FILE, REREAD_WINDOW)
+        if checkpoint.offset is not None:
+            # the watermarks of completed metrics were not persisted yet
+            ws_watermarks = watermarks.watermarks.setdefault(ws["uuid"], {})
+            for metric_uuid, watermark in checkpoint.completed_metrics.items():
+                if watermark is not None:
+                    ws_watermarks[metric_uuid] = watermark
+
+    dprint()
+    dprint(f"processing workspace {ws['name']}")
+
+    # in flight requests and throughput are printed every 30s and when done
+    with FetchPool(CONCURRENCY, stats=stats) as pool:
+        datapoints = iter_workspace_datapoints(
+            ws, start_ts, end_ts, pool, watermarks, checkpoint
+        )
+        num_rows = export_datapoints(ws["uuid"], datapoints, export_dir, checkpoint)
+
+    print(f"workspace '{ws['name']}' {pool.status()}")
+    stats.count("rows", num_rows)
+    if metadata_cache.enabled:
+        stats.count("metadata_cache_hits", metadata_cache.hits)
+    dprint(f"metric datapoints export for workspace '{ws['name']}' completed")
+    dprint(stats.summary())
+
+    ws_watermarks = watermarks.watermarks.get(ws["uuid"]) if watermarks else None
+    checkpoint.complete_workspace(ws_watermarks)
+
+    return {
+        "workspace": ws["name"],
+        "rows": checkpoint.rows,
+        "seconds": time.time() - ws_start_ts,
+        "requests": pool.completed,
+        "pid": os.getpid(),
+        "watermarks": ws_watermarks,
+        "stats": stats.to_dict(),
+    }
 
-    workspaces = workspace_client.list_workspaces()
-    dprint(f"processing {len(workspaces)=}")
 
-    export_time = int(time.time())
+def get_output_settings() -> dict:
+    """output options recorded in the checkpoint, reused by --resume"""
+    return {
+        "format": EXPORT_FORMAT,
+        "compression": COMPRESSION,
+        "compressionLevel": COMPRESSION_LEVEL,
+        "maxRowsPerFile": MAX_ROWS_PER_FILE,
+        "maxBytesPerFile": MAX_BYTES_PER_FILE,
+        "sink": SINK,
+    }
 
-    for ws in workspaces:
-        ws_start_ts = time.time()
 
-        workspace_id = ws["uuid"]
-        dprint()
-        dprint(f"processing workspace {ws['name']}")
-        datapoints = get_workspace_datapoints(ws, start_ts, end_ts)
-        export_to_csv(workspace_id, datapoints, int(export_time))
-        dprint(
-            f"metric datapoints export for workspace '{ws['name']}' completed in "
-            f"{time.time()-ws_start_ts} seconds."
+def main(num_days: int = 1, resume_dir: Optional[str] = None):
+    main_start_ts = time.time()
+    run_stats = Instrumentation()
+
+    if resume_dir:
+        run = load_run(resume_dir)
+        start_ts = run["startTs"]
+        end_ts = run["endTs"]
+        export_dir = resume_dir
+    else:
+        # incremental runs are expected to run more often than daily
+        end_ts = arrow.utcnow().floor("hour" if INCREMENTAL_STATE_FILE else "day")
+        start_ts = end_ts.shift(days=-num_days).timestamp()
+        end_ts = end_ts.timestamp()
+
+        export_dir = create_export_dir(
+            EXPORT_DIRECTORY_PATH.rstrip("/"), str(int(time.time()))
+        )
+        save_run(
+            export_dir, {"startTs": start_ts, "endTs": end_ts, **get_output_settings()}
         )
 
-    print(f"export completed in {time.time() - main_start_ts} seconds")
+    dprint(
+        f"start_ts={arrow.get(start_ts).format()}, end_ts={arrow.get(end_ts).format()}"
+    )
+
+    with run_stats.span("list_metadata"), run_stats.request("list_workspaces"):
+        workspaces = workspace_client.list_workspaces()
+    dprint(f"processing {len(workspaces)=}")
+
+    watermarks = None
+    if INCREMENTAL_STATE_FILE:
+        watermarks = WatermarkState(INCREMENTAL_STATE_FILE, REREAD_WINDOW)
+
+    summaries = []
+    for ws, summary in process_map(
+        partial(
+            export_workspace,
+            start_ts=start_ts,
+            end_ts=end_ts,
+            export_dir=export_dir,
+            resume=bool(resume_dir),
+        ),
+        workspaces,
+        WORKERS,
+        init_worker,
+        (get_settings(),),
+    ):
+        summaries.append(summary)
+        run_stats.merge(summary.get("stats"))
+        if watermarks is not None and summary["watermarks"]:
+            # only persist watermarks once the rows are written
+            watermarks.watermarks[ws["uuid"]] = summary["watermarks"]
+            watermarks.save()
+
+    print(format_workspace_summary(summaries, time.time() - main_start_ts))
+    print(run_stats.summary())
+    if STATS_FILE:
+        run_stats.write_json(STATS_FILE)
+    return summaries
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Export datapoints for all workspaces for the last n days"
     )
+    parser.add_argument("--days", type=int, help="Number of days to lookback")
+    parser.add_argument("--debug", action="store_true", help="Enable debug mode")
+    parser.add_argument("--path", type=str, help="Path to store the export files")
+    add_writer_arguments(parser, EXPORT_FORMAT)
     parser.add_argument(
-        "--days", type=int, help="Number of days to lookback", required=True
+        "--concurrency",
+        type=int,
+        default=CONCURRENCY,
+        help="Number of concurrent datapoint and incident requests",
+    )
+    parser.add_argument(
+        "--fetch-window-hours",
+        type=int,
+        help="Fetch datapoints of longer ranges in concurrent windows, starting "
+        "with a window of this many hours",
+    )
+    parser.add_argument(
+        "--target-window-datapoints",
+        type=int,
+        default=TARGET_WINDOW_DATAPOINTS,
+        help="Number of datapoints the adapted fetch windows aim to hold",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default=ENGINE,
+        help="Join monitor datapoints row by row or vectorized, which requires "
+        "numpy",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="Number of worker processes to spread the workspaces across",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only export datapoints newer than the previous incremental run",
+    )
+    parser.add_argument(
+        "--state-file",
+        type=str,
+        help="Watermark state file for --incremental, defaults to "
+        "<path>/datapoint_watermarks.json",
+    )
+    parser.add_argument(
+        "--reread-window",
+        type=int,
+        default=REREAD_WINDOW,
+        help="Seconds before the watermark to re-read for late datapoints",
+    )
+    parser.add_argument(
+        "--stats-file",
+        type=str,
+        help="Write phase timings and request latencies to this json file",
+    )
+    parser.add_argument(
+        "--metadata-cache-ttl",
+        type=float,
+        help="Reuse the workspace source, metric and monitor listings cached "
+        "in the last n seconds, 0 disables the cache. Listings are not checked "
+        "for changes made within the ttl",
+    )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        help="Export directory of an interrupted export to resume, the window "
+        "and output options are taken from its checkpoint",
     )
-    parser.add_argument("--debug", action="store_true", help="Enable debug mode")
-    parser.add_argument("--path", type=str, help="Path to store the csv files")
 
     args = parser.parse_args()
+    if args.days is None and not args.resume:
+        parser.error("--days is required unless resuming an export")
 
     DEBUG = args.debug or DEBUG
     EXPORT_DIRECTORY_PATH = args.path or EXPORT_DIRECTORY_PATH
+    CONCURRENCY = args.concurrency
+    FETCH_WINDOW_HOURS = args.fetch_window_hours
+    TARGET_WINDOW_DATAPOINTS = args.target_window_datapoints
+    ENGINE = args.engine
+    EXPORT_FORMAT = args.format
+    COMPRESSION = args.compression
+    COMPRESSION_LEVEL = args.compression_level
+    MAX_ROWS_PER_FILE = args.max_rows_per_file
+    MAX_BYTES_PER_FILE = args.max_bytes_per_file
+    SINK = args.sink
+    REREAD_WINDOW = args.reread_window
+    WORKERS = args.workers
+    STATS_FILE = args.stats_file
+    METADATA_CACHE_TTL = args.metadata_cache_ttl
+    if args.incremental:
+        INCREMENTAL_STATE_FILE = args.state_file or os.path.join(
+            EXPORT_DIRECTORY_PATH, "datapoint_watermarks.json"
+        )
+    if args.resume:
+        output_settings = load_run(args.resume)
+        EXPORT_FORMAT = output_settings["format"]
+        COMPRESSION = output_settings["compression"]
+        COMPRESSION_LEVEL = output_settings["compressionLevel"]
+        MAX_ROWS_PER_FILE = output_settings["maxRowsPerFile"]
+        MAX_BYTES_PER_FILE = output_settings["maxBytesPerFile"]
+        SINK = output_settings.get("sink")
 
     print(
         f"exporting datapoints for the last {args.days} days to "
-        f"path={EXPORT_DIRECTORY_PATH}. debug={DEBUG} "
+        f"path={EXPORT_DIRECTORY_PATH}. debug={DEBUG} concurrency={CONCURRENCY} "
+        f"format={EXPORT_FORMAT} sink={SINK} workers={WORKERS} "
+        f"incremental_state_file={INCREMENTAL_STATE_FILE} resume={args.resume}"
     )
 
-    main(args.days)
+    main(args.days, args.resume)
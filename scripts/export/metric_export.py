@@ -6,180 +6,369 @@ data asset information as well as monitor information. Depends on lightctl, if
 the dependencies for this repo are met, this script will run.
 
 Export metrics for each workspace in the following path:
-path/<export_epoch_time>/<workspace_uuid>.csv
+path/<export_epoch_time>/<workspace_uuid>.<csv|parquet|arrows>
+
+Use --compression to gzip/zstd compress the output while streaming and
+--max-rows-per-file/--max-bytes-per-file to rotate it into numbered parts
+path/<export_epoch_time>/<workspace_uuid>.part-<n>.<extension> listed in
+path/<export_epoch_time>/<workspace_uuid>.manifest.json.
+
+The source, metric and monitor listings of a workspace are requested
+concurrently and the metric rows are written as they are built, --workers
+exports that many workspaces at a time. The monitors column holds the JSON list
+of the metric's monitors.
+
+Use --sink sqlite:///<path>.db to upsert the metrics into the metrics table of a
+SQLite database instead, keyed by metricUuid with the monitors as JSON.
+
+Use --metadata-cache-ttl to reuse the source, metric and monitor listings of
+runs in the last n seconds, see metadata_cache.py. The ttl is the only
+freshness check, configuration changed within it is exported as cached.
 
 See usage: python metric_export.py --help
 """
 
 import argparse
-import csv
 import os
 import time
+from functools import partial
+from itertools import chain
+from typing import Iterator
 
 from lightctl.client.metric_client import MetricClient
 from lightctl.client.monitor_client import MonitorClient
 from lightctl.client.source_client import SourceClient
 from lightctl.client.workspace_client import WorkspaceClient
 
+from scripts.common.concurrency import FetchPool, format_workspace_summary, process_map
+from scripts.common.instrumentation import Instrumentation
+from scripts.common.metadata_cache import MetadataCache, list_workspace_metadata
+from scripts.export.writers import (
+    add_writer_arguments,
+    open_row_writer,
+    open_sink_writer,
+)
+
 EXPORT_DIRECTORY_PATH = "/tmp/lightupexport/"
 DEBUG = False
 
+# one of writers.FORMATS
+EXPORT_FORMAT = "csv"
+
+# output compression and rotation, see writers.open_row_writer
+COMPRESSION = None
+COMPRESSION_LEVEL = None
+MAX_ROWS_PER_FILE = None
+MAX_BYTES_PER_FILE = None
+
+# e.g. sqlite:///<path>, writes the rows to a database instead of files
+SINK = None
+
+# number of worker processes, workspaces are spread across the workers
+WORKERS = 1
+
+# json file for the phase timings and request latencies of the export
+STATS_FILE = None
+
+# instrumentation of the workspace being exported, see instrumentation.py
+stats = Instrumentation()
+
+# seconds the workspace listings are reused from the local metadata cache,
+# None reads LIGHTSCRIPT_METADATA_CACHE_TTL and 0 disables the cache
+METADATA_CACHE_TTL = None
+
+# cache of the workspace being exported, see metadata_cache.py
+metadata_cache = MetadataCache(0)
+
+MONITOR_COLUMNS = [
+    ("monitorName", "string"),
+    ("monitorUuid", "string"),
+    ("monitorId", "int"),
+    ("monitorTags", "string_list"),
+    ("monitorIsLive", "bool"),
+    ("monitorLiveStartTs", "timestamp"),
+    ("monitorLastSampleTs", "timestamp"),
+    ("monitorRunStatus", "category"),
+    ("monitorConfigUpdatedTs", "timestamp"),
+]
+
+# output columns and their types for parquet/arrow output, see writers.py
+METRIC_COLUMNS = [
+    ("workspaceId", "category"),
+    ("workspaceName", "category"),
+    ("metricName", "string"),
+    ("metricUuid", "string"),
+    ("metricId", "int"),
+    ("metricCreationType", "category"),
+    ("metricDescription", "string"),
+    ("metricTags", "string_list"),
+    ("metricDimension", "category"),
+    ("metricConfigType", "category"),
+    ("sourceUuid", "category"),
+    ("sourceName", "category"),
+    ("schemaName", "category"),
+    ("tableName", "category"),
+    ("schemaUuid", "category"),
+    ("tableUuid", "category"),
+    ("collectionMode", "category"),
+    ("columnName", "string"),
+    ("columnUuid", "string"),
+    ("metricIsLive", "bool"),
+    ("metricLastSampleTs", "timestamp"),
+    ("metricConfigUpdatedTs", "timestamp"),
+    ("metricRunStatus", "category"),
+    ("monitors", MONITOR_COLUMNS),
+]
+
+# identifies a row of a sink table, a re-exported metric replaces the existing one
+METRIC_KEY_COLUMNS = ["metricUuid"]
+
 
 def dprint(*args):
     if DEBUG:
         print(*args)
 
 
-def export_to_csv(workspace_id: str, metric_map: dict, start_time: int):
-    start_ts = time.time()
-
-    if not metric_map:
-        return
+def export_metrics(workspace_id: str, rows: Iterator[dict], start_time: int) -> int:
+    """
+    streams the metric rows of a workspace to its file or the sink, no file is
+    written for a workspace without metrics
+    """
+    first_row = next(rows, None)
+    if first_row is None:
+        return 0
 
     path = EXPORT_DIRECTORY_PATH.rstrip("/") + f"/{start_time}"
 
-    csv_file = f"{path}/{workspace_id}.csv"
-    csv_columns = [
-        "workspaceId",
-        "workspaceName",
-        "metricName",
-        "metricUuid",
-        "metricId",
-        "metricCreationType",
-        "metricDescription",
-        "metricTags",
-        "metricDimension",
-        "metricConfigType",
-        "sourceUuid",
-        "sourceName",
-        "schemaName",
-        "tableName",
-        "schemaUuid",
-        "tableUuid",
-        "collectionMode",
-        "columnName",
-        "columnUuid",
-        "metricIsLive",
-        "metricLastSampleTs",
-        "metricConfigUpdatedTs",
-        "metricRunStatus",
-        "monitors",
-    ]
-
-    if not os.path.exists(path):
-        os.makedirs(path)
+    # workers may create the export directory concurrently
+    os.makedirs(path, exist_ok=True)
 
     try:
-        with open(csv_file, "w", encoding="utf-8") as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=csv_columns)
-            writer.writeheader()
-            for data in metric_map.values():
-                writer.writerow(data)
-    except OSError:
-        print("I/O error {ex}")
+        if SINK:
+            writer = open_sink_writer(
+                SINK, "metrics", METRIC_COLUMNS, METRIC_KEY_COLUMNS
+            )
+        else:
+            writer = open_row_writer(
+                EXPORT_FORMAT,
+                f"{path}/{workspace_id}",
+                METRIC_COLUMNS,
+                COMPRESSION,
+                COMPRESSION_LEVEL,
+                MAX_ROWS_PER_FILE,
+                MAX_BYTES_PER_FILE,
+            )
+        with stats.span("write"), writer:
+            for row in chain([first_row], rows):
+                writer.write(row)
+    except OSError as ex:
+        print(f"I/O error {ex}")
         raise
 
-    dprint(f"write to {csv_file} completed in {time.time() - start_ts} seconds")
+    dprint(f"wrote {writer.num_rows} rows to {writer.file_path}")
+    return writer.num_rows
 
 
-def main():
-    export_time = time.time()
+def init_clients():
+    global workspace_client, source_client, metric_client, monitor_client
 
     workspace_client = WorkspaceClient()
     source_client = SourceClient()
     metric_client = MetricClient()
     monitor_client = MonitorClient()
 
-    workspaces = workspace_client.list_workspaces()
-
-    for ws in workspaces:
-        start_time = time.time()
-        workspace_id = ws["uuid"]
-        dprint()
-        dprint(f"processing workspace {ws['name']} ({ws['uuid']})")
 
-        sources = source_client.list_sources(workspace_id)
-        metrics = metric_client.list_metrics(workspace_id)
-        monitors = monitor_client.list_monitors(workspace_id)
-
-        source_map = {
-            source["metadata"]["uuid"]: source["metadata"]["name"] for source in sources
+def get_settings() -> dict:
+    return {
+        "DEBUG": DEBUG,
+        "EXPORT_DIRECTORY_PATH": EXPORT_DIRECTORY_PATH,
+        "EXPORT_FORMAT": EXPORT_FORMAT,
+        "COMPRESSION": COMPRESSION,
+        "COMPRESSION_LEVEL": COMPRESSION_LEVEL,
+        "MAX_ROWS_PER_FILE": MAX_ROWS_PER_FILE,
+        "MAX_BYTES_PER_FILE": MAX_BYTES_PER_FILE,
+        "SINK": SINK,
+        "STATS_FILE": STATS_FILE,
+        "METADATA_CACHE_TTL": METADATA_CACHE_TTL,
+    }
+
+
+def init_worker(settings: dict):
+    """process pool initializer, applies the settings and creates new clients"""
+    globals().update(settings)
+    init_clients()
+
+
+def list_workspace(workspace_id: str) -> tuple[list, list, list]:
+    """
+    lists the sources, metrics and monitors of a workspace, the three requests
+    are issued concurrently
+    """
+    with FetchPool(3) as pool:
+        futures = [
+            pool.submit(
+                list_workspace_metadata,
+                metadata_cache,
+                kind,
+                workspace_id,
+                list_fn,
+                stats,
+            )
+            for kind, list_fn in [
+                ("sources", source_client.list_sources),
+                ("metrics", metric_client.list_metrics),
+                ("monitors", monitor_client.list_monitors),
+            ]
+        ]
+        return tuple(future.result() for future in futures)
+
+
+def get_monitor_row(monitor: dict) -> dict:
+    return {
+        "monitorName": monitor["metadata"]["name"],
+        "monitorUuid": monitor["metadata"]["uuid"],
+        "monitorId": monitor["metadata"]["idSerial"],
+        "monitorTags": monitor["metadata"].get("tags", []),
+        "monitorIsLive": monitor["config"]["isLive"],
+        "monitorLiveStartTs": monitor["config"].get("liveStartTs", ""),
+        "monitorLastSampleTs": monitor["status"].get("lastSampleTs", ""),
+        "monitorRunStatus": monitor["status"].get("runStatus", ""),
+        "monitorConfigUpdatedTs": monitor["status"].get("configUpdatedTs"),
+    }
+
+
+def iter_metric_rows(
+    ws: dict, metrics: list[dict], source_map: dict, monitors_by_metric: dict
+) -> Iterator[dict]:
+    """yields the row of each metric of the workspace, skipping compare metrics"""
+    workspace_id = ws["uuid"]
+    for metric in metrics:
+        # skip compare metrics
+        if metric["config"]["configType"] not in [
+            "metricConfig",
+            "fullTableMetricConfig",
+        ]:
+            continue
+
+        metric_uuid = metric["metadata"]["uuid"]
+        row = {
+            "workspaceId": workspace_id,
+            "workspaceName": ws["name"],
+            "metricName": metric["metadata"]["name"],
+            "metricUuid": metric_uuid,
+            "metricId": metric["metadata"]["idSerial"],
+            "metricCreationType": metric["metadata"]["creationType"],
+            "metricDescription": metric["metadata"].get("description", ""),
+            "metricTags": metric["metadata"].get("tags", []),
+            "metricConfigType": metric["config"]["configType"],
+            "metricDimension": metric["config"]["dimension"],
+            "sourceUuid": metric["config"]["sources"][0],
+            "sourceName": source_map.get(metric["config"]["sources"][0], ""),
+            "schemaUuid": metric["config"]["table"].get("schemaUuid", ""),
+            "tableUuid": metric["config"]["table"].get("tableUuid", ""),
+            "schemaName": metric["config"]["table"].get("schemaName", ""),
+            "tableName": metric["config"]["table"].get("tableName", ""),
+            "collectionMode": "",
+            "columnName": "",
+            "columnUuid": "",
+            "metricIsLive": metric["config"]["isLive"],
+            "metricLastSampleTs": metric["status"].get("lastSampleTs", ""),
+            "metricConfigUpdatedTs": metric["status"].get("configUpdatedTs"),
+            "metricRunStatus": metric["status"].get("runStatus"),
+            # monitors of compare metrics are never looked up
+            "monitors": monitors_by_metric.get(metric_uuid, []),
         }
 
-        metric_map = {}
-        for metric in metrics:
-            # skip compare metrics
-            if metric["config"]["configType"] not in [
-                "metricConfig",
-                "fullTableMetricConfig",
-            ]:
-                continue
-
-            metric_uuid = metric["metadata"]["uuid"]
-            metric_map[metric_uuid] = {
-                "workspaceId": workspace_id,
-                "workspaceName": ws["name"],
-                "metricName": metric["metadata"]["name"],
-                "metricUuid": metric_uuid,
-                "metricId": metric["metadata"]["idSerial"],
-                "metricCreationType": metric["metadata"]["creationType"],
-                "metricDescription": metric["metadata"].get("description", ""),
-                "metricTags": metric["metadata"].get("tags", []),
-                "metricConfigType": metric["config"]["configType"],
-                "metricDimension": metric["config"]["dimension"],
-                "sourceUuid": metric["config"]["sources"][0],
-                "sourceName": source_map.get(metric["config"]["sources"][0], ""),
-                "schemaUuid": metric["config"]["table"].get("schemaUuid", ""),
-                "tableUuid": metric["config"]["table"].get("tableUuid", ""),
-                "schemaName": metric["config"]["table"].get("schemaName", ""),
-                "tableName": metric["config"]["table"].get("tableName", ""),
-                "collectionMode": "",
-                "columnName": "",
-                "columnUuid": "",
-                "metricIsLive": metric["config"]["isLive"],
-                "metricLastSampleTs": metric["status"].get("lastSampleTs", ""),
-                "metricConfigUpdatedTs": metric["status"].get("configUpdatedTs"),
-                "metricRunStatus": metric["status"].get("runStatus"),
-                "monitors": [],
-            }
-
-            if columns := metric["config"].get("valueColumns"):
-                metric_map[metric_uuid].update(
-                    {
-                        "columnName": columns[0]["columnName"],
-                        "columnUuid": columns[0].get("columnUuid"),
-                    }
-                )
-
-            if collection_mode := metric["config"].get("collectionMode"):
-                metric_map[metric_uuid]["collectionMode"] = collection_mode["type"]
-
-        for monitor in monitors:
-            metric_uuid = monitor["config"]["metrics"][0]
-
-            if metric_map.get(metric_uuid) is None:
-                # skip monitors for compare metrics
-                continue
-
-            metric_map[metric_uuid]["monitors"].append(
+        if columns := metric["config"].get("valueColumns"):
+            row.update(
                 {
-                    "monitorName": monitor["metadata"]["name"],
-                    "monitorUuid": monitor["metadata"]["uuid"],
-                    "monitorId": monitor["metadata"]["idSerial"],
-                    "monitorTags": monitor["metadata"].get("tags", []),
-                    "monitorIsLive": monitor["config"]["isLive"],
-                    "monitorLiveStartTs": monitor["config"].get("liveStartTs", ""),
-                    "monitorLastSampleTs": monitor["status"].get("lastSampleTs", ""),
-                    "monitorRunStatus": monitor["status"].get("runStatus", ""),
-                    "monitorConfigUpdatedTs": monitor["status"].get("configUpdatedTs"),
+                    "columnName": columns[0]["columnName"],
+                    "columnUuid": columns[0].get("columnUuid"),
                 }
             )
 
-        export_to_csv(workspace_id, metric_map, int(export_time))
-        dprint(
-            f"metric export for workspace '{ws['name']}' completed in "
-            f"{time.time()-start_time} seconds."
-        )
+        if collection_mode := metric["config"].get("collectionMode"):
+            row["collectionMode"] = collection_mode["type"]
+
+        yield row
+
+
+def export_workspace(ws: dict, export_time: float) -> dict:
+    """
+    exports the metrics of a single workspace, runs in a worker process when
+    WORKERS > 1. returns a summary of the export along with its stats.
+    """
+    global stats, metadata_cache
+    stats = Instrumentation()
+    metadata_cache = MetadataCache(METADATA_CACHE_TTL, metric_client.url_base)
+    start_time = time.time()
+    workspace_id = ws["uuid"]
+    dprint()
+    dprint(f"processing workspace {ws['name']} ({ws['uuid']})")
+
+    with stats.span("list_metadata"):
+        sources, metrics, monitors = list_workspace(workspace_id)
+
+    build_start_ts = time.perf_counter()
+
+    source_map = {
+        source["metadata"]["uuid"]: source["metadata"]["name"] for source in sources
+    }
+
+    monitors_by_metric = {}
+    for monitor in monitors:
+        metric_uuid = monitor["config"]["metrics"][0]
+        monitors_by_metric.setdefault(metric_uuid, []).append(get_monitor_row(monitor))
+
+    stats.add_span("build_rows", time.perf_counter() - build_start_ts)
+
+    # the rows are built while they are written
+    num_rows = export_metrics(
+        workspace_id,
+        iter_metric_rows(ws, metrics, source_map, monitors_by_metric),
+        int(export_time),
+    )
+    stats.count("rows", num_rows)
+    if metadata_cache.enabled:
+        stats.count("metadata_cache_hits", metadata_cache.hits)
+    dprint(f"metric export for workspace '{ws['name']}' completed")
+    dprint(stats.summary())
+
+    return {
+        "workspace": ws["name"],
+        "rows": num_rows,
+        "seconds": time.time() - start_time,
+        "requests": metadata_cache.fetches,
+        "pid": os.getpid(),
+        "stats": stats.to_dict(),
+    }
+
+
+def main():
+    export_time = time.time()
+    run_stats = Instrumentation()
+
+    init_clients()
+
+    with run_stats.span("list_metadata"), run_stats.request("list_workspaces"):
+        workspaces = workspace_client.list_workspaces()
+
+    summaries = []
+    for _, summary in process_map(
+        partial(export_workspace, export_time=export_time),
+        workspaces,
+        WORKERS,
+        init_worker,
+        (get_settings(),),
+    ):
+        summaries.append(summary)
+        run_stats.merge(summary.get("stats"))
+
+    print(format_workspace_summary(summaries, time.time() - export_time))
+    print(run_stats.summary())
+    if STATS_FILE:
+        run_stats.write_json(STATS_FILE)
+    return summaries
 
 
 if __name__ == "__main__":
@@ -187,11 +376,39 @@ if __name__ == "__main__":
         description="Export list of configured metrics and associated monitors"
     )
     parser.add_argument("--debug", action="store_true", help="Enable debug mode")
-    parser.add_argument("--path", type=str, help="Path to store the csv files")
+    parser.add_argument("--path", type=str, help="Path to store the export files")
+    add_writer_arguments(parser, EXPORT_FORMAT)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="Number of worker processes to spread the workspaces across",
+    )
+    parser.add_argument(
+        "--stats-file",
+        type=str,
+        help="Write phase timings and request latencies to this json file",
+    )
+    parser.add_argument(
+        "--metadata-cache-ttl",
+        type=float,
+        help="Reuse the workspace source, metric and monitor listings cached "
+        "in the last n seconds, 0 disables the cache. Listings are not checked "
+        "for changes made within the ttl",
+    )
 
     args = parser.parse_args()
 
     DEBUG = args.debug or DEBUG
     EXPORT_DIRECTORY_PATH = args.path or EXPORT_DIRECTORY_PATH
+    EXPORT_FORMAT = args.format
+    COMPRESSION = args.compression
+    COMPRESSION_LEVEL = args.compression_level
+    MAX_ROWS_PER_FILE = args.max_rows_per_file
+    MAX_BYTES_PER_FILE = args.max_bytes_per_file
+    SINK = args.sink
+    WORKERS = args.workers
+    STATS_FILE = args.stats_file
+    METADATA_CACHE_TTL = args.metadata_cache_ttl
 
     main()
@@ -0,0 +1,246 @@
+"""
+Vectorized join engine for metric_datapoint_export, `--engine vectorized`.
+
+Produces the same rows as the per row join of the python engine: for each
+datapoint, the monitor datapoint (filter stat) of the same slice within
+`precision` of its eventTs, the last one in monitor datapoint order when
+several match, and whether the matched timestamp is inside an incident of the
+stat's monitor and slice.
+
+The datapoints and monitor datapoints of a metric are turned into columnar
+arrays of slice codes and timestamps. The tolerance join and the incident
+interval lookup are both done for all slices at once with a searchsorted on
+(slice code, timestamp) pairs, see _lex_searchsorted. Only the row tuples are
+still built one at a time, by the same datapoint_rows functions as the python
+engine.
+
+Requires numpy.
+"""
+
+from typing import Iterator
+
+import numpy as np
+
+from scripts.common.incidents import IncidentIndex
+from scripts.common.slices import SliceInterner
+from scripts.export.datapoint_rows import (
+    DatapointRow,
+    MetricColumns,
+    get_datapoint_row,
+    get_monitor_row,
+)
+
+
+def _lex_searchsorted(
+    codes: np.ndarray,
+    values: np.ndarray,
+    query_codes: np.ndarray,
+    query_values: np.ndarray,
+    side: str = "left",
+) -> np.ndarray:
+    """
+    np.searchsorted for (code, value) pairs, codes and values must be sorted
+    by code and then by value
+    """
+    num_sorted = len(codes)
+    is_query = np.concatenate(
+        [np.zeros(num_sorted, dtype=bool), np.ones(len(query_codes), dtype=bool)]
+    )
+    # with side="left" a query is placed before equal pairs, otherwise after
+    tiebreak = is_query if side == "right" else ~is_query
+    order = np.lexsort(
+        (
+            tiebreak,
+            np.concatenate([values, query_values]),
+            np.concatenate([codes, query_codes]),
+        )
+    )
+
+    sorted_is_query = is_query[order]
+    num_before = np.cumsum(~sorted_is_query) - ~sorted_is_query
+
+    positions = np.empty(len(query_codes), dtype=np.int64)
+    positions[order[sorted_is_query] - num_sorted] = num_before[sorted_is_query]
+    return positions
+
+
+class SliceCodes:
+    """assigns consecutive integer codes to SliceKeys"""
+
+    def __init__(self):
+        self.codes = {}
+
+    def encode(self, keys: list) -> np.ndarray:
+        codes = self.codes
+        return np.fromiter(
+            (codes.setdefault(key, len(codes)) for key in keys),
+            dtype=np.int64,
+            count=len(keys),
+        )
+
+
+def match_filter_stats(
+    dp_codes: np.ndarray,
+    dp_ts: np.ndarray,
+    stat_codes: np.ndarray,
+    stat_ts: np.ndarray,
+    precision: float = 0.001,
+) -> np.ndarray:
+    """
+    returns, for each datapoint, the position of the last stat with the same
+    slice code within precision of its timestamp, -1 when there is none
+    """
+    matches = np.full(len(dp_codes), -1, dtype=np.int64)
+    if not len(stat_codes):
+        return matches
+
+    order = np.lexsort((stat_ts, stat_codes))
+    sorted_codes = stat_codes[order]
+    sorted_ts = stat_ts[order]
+
+    # candidates are searched in a wider window and then checked with the
+    # same comparison as the python engine, so rounding at the window edges
+    # can not change the result
+    lo = _lex_searchsorted(
+        sorted_codes, sorted_ts, dp_codes, dp_ts - 2 * precision, "left"
+    )
+    hi = _lex_searchsorted(
+        sorted_codes, sorted_ts, dp_codes, dp_ts + 2 * precision, "right"
+    )
+
+    for offset in range(int((hi - lo).max(initial=0))):
+        candidates = lo + offset
+        in_window = candidates < hi
+        candidates = np.where(in_window, candidates, 0)
+        matched = in_window & (np.abs(dp_ts - sorted_ts[candidates]) < precision)
+        matches = np.where(matched, np.maximum(matches, order[candidates]), matches)
+    return matches
+
+
+def flag_incidents(
+    incidents: IncidentIndex,
+    monitor_uuid: str,
+    slice_codes: SliceCodes,
+    row_codes: np.ndarray,
+    row_ts: np.ndarray,
+) -> np.ndarray:
+    """
+    returns, for each row, whether its timestamp is inside an incident of the
+    monitor and the row's slice, see IncidentIndex.contains
+    """
+    group_codes = []
+    starts = []
+    max_ends = []
+    for key, code in slice_codes.codes.items():
+        intervals = incidents.intervals(monitor_uuid, key)
+        if intervals is None:
+            continue
+        group_codes.append(np.full(len(intervals[0]), code, dtype=np.int64))
+        starts.append(np.asarray(intervals[0], dtype=np.float64))
+        max_ends.append(np.asarray(intervals[1], dtype=np.float64))
+
+    if not group_codes:
+        return np.zeros(len(row_codes), dtype=bool)
+
+    group_codes = np.concatenate(group_codes)
+    starts = np.concatenate(starts)
+    max_ends = np.concatenate(max_ends)
+
+    # the same bisect_right as IncidentIndex.contains, within the row's slice
+    order = np.lexsort((starts, group_codes))
+    group_codes = group_codes[order]
+    starts = starts[order]
+    max_ends = max_ends[order]
+    positions = _lex_searchsorted(group_codes, starts, row_codes, row_ts, "right")
+    previous = np.maximum(positions - 1, 0)
+    return (
+        (positions > 0)
+        & (group_codes[previous] == row_codes)
+        & (max_ends[previous] >= row_ts)
+    )
+
+
+def iter_metric_rows(
+    datapoints: list[dict],
+    metric_columns: MetricColumns,
+    monitors: list[dict],
+    monitor_datapoints_map: dict,
+    incidents: IncidentIndex,
+) -> Iterator[DatapointRow]:
+    """
+    yields the rows of a metric in the same order as the python engine, one
+    row per datapoint and monitor or a single row without monitors
+    """
+    slices = SliceInterner()
+    rows = [get_datapoint_row(dp, metric_columns, slices) for dp in datapoints]
+    if not monitors:
+        yield from rows
+        return
+
+    slice_codes = SliceCodes()
+    dp_codes = slice_codes.encode([row.slice for row in rows])
+    dp_ts = np.fromiter(
+        (row.eventTs for row in rows), dtype=np.float64, count=len(rows)
+    )
+
+    monitor_columns = []
+    for monitor in monitors:
+        monitor_uuid = monitor["metadata"]["uuid"]
+        stats = monitor_datapoints_map[monitor_uuid]
+        matches = match_filter_stats(
+            dp_codes,
+            dp_ts,
+            slice_codes.encode([slices.intern(stat["slice"]) for stat in stats]),
+            np.fromiter(
+                (stat["time"] for stat in stats), dtype=np.float64, count=len(stats)
+            ),
+        )
+
+        # incidents are looked up for the monitor of the matched stat
+        incident_flags = np.zeros(len(rows), dtype=bool)
+        matched = matches >= 0
+        stat_monitors = np.array(
+            [stats[pos]["filter_uuid"] for pos in matches[matched]], dtype=object
+        )
+        for stat_monitor in set(stat_monitors):
+            rows_of_monitor = np.flatnonzero(matched)[stat_monitors == stat_monitor]
+            incident_flags[rows_of_monitor] = flag_incidents(
+                incidents,
+                stat_monitor,
+                slice_codes,
+                dp_codes[rows_of_monitor],
+                dp_ts[rows_of_monitor],
+            )
+
+        monitor_columns.append(
+            (
+                monitor_uuid,
+                monitor["metadata"]["name"],
+                stats,
+                matches.tolist(),
+                incident_flags.tolist(),
+            )
+        )
+
+    for i, row in enumerate(rows):
+        for (
+            monitor_uuid,
+            monitor_name,
+            stats,
+            matches,
+            incident_flags,
+        ) in monitor_columns:
+            pos = matches[i]
+            if pos < 0:
+                yield get_monitor_row(row, monitor_uuid, monitor_name)
+                continue
+            stat = stats[pos]
+            yield get_monitor_row(
+                row,
+                monitor_uuid,
+                monitor_name,
+                stat["filtered_obs_val"],
+                stat["lower_exp_limit"],
+                stat["upper_exp_limit"],
+                incident_flags[i],
+            )
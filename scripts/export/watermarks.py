@@ -0,0 +1,84 @@
+"""
+Per workspace/metric watermarks for incremental datapoint exports.
+
+The watermark of a metric is the largest eventTs and recordedTs exported so
+far. An incremental run re-reads `reread_window` seconds before the eventTs
+watermark and only exports datapoints that are newer than the watermark by
+eventTs, or were recorded after it. Late arriving datapoints within the
+re-read window are therefore picked up while already exported ones are
+skipped.
+
+State file format:
+{"<workspace_uuid>": {"<metric_uuid>": {"eventTs": float, "recordedTs": float}}}
+"""
+
+import json
+import os
+from typing import Optional
+
+
+class WatermarkState:
+    def __init__(self, state_file: str, reread_window: float = 3600):
+        self.state_file = state_file
+        self.reread_window = reread_window
+        self.watermarks = {}
+
+        if os.path.exists(state_file):
+            with open(state_file, encoding="utf-8") as f:
+                self.watermarks = json.load(f)
+
+    def get(self, workspace_id: str, metric_uuid: str) -> Optional[dict]:
+        return self.watermarks.get(workspace_id, {}).get(metric_uuid)
+
+    def get_fetch_start_ts(
+        self, workspace_id: str, metric_uuid: str, start_ts: float
+    ) -> float:
+        """returns the start of the window to fetch for a metric"""
+        watermark = self.get(workspace_id, metric_uuid)
+        if watermark is None:
+            return start_ts
+        return max(start_ts, watermark["eventTs"] - self.reread_window)
+
+    def filter_new(
+        self, workspace_id: str, metric_uuid: str, datapoints: list[dict]
+    ) -> list[dict]:
+        """
+        returns the datapoints that are newer than the metric watermark and
+        advances the watermark past them
+        """
+        watermark = self.get(workspace_id, metric_uuid)
+        if watermark is None:
+            new_datapoints = datapoints
+            watermark = {"eventTs": -float("inf"), "recordedTs": -float("inf")}
+        else:
+            new_datapoints = [
+                dp
+                for dp in datapoints
+                if dp["eventTs"] > watermark["eventTs"]
+                or (dp.get("recordedTs") or 0) > watermark["recordedTs"]
+            ]
+
+        if not new_datapoints:
+            return new_datapoints
+
+        self.watermarks.setdefault(workspace_id, {})[metric_uuid] = {
+            "eventTs": max(
+                watermark["eventTs"], max(dp["eventTs"] for dp in new_datapoints)
+            ),
+            "recordedTs": max(
+                watermark["recordedTs"],
+                max(dp.get("recordedTs") or 0 for dp in new_datapoints),
+            ),
+        }
+        return new_datapoints
+
+    def save(self):
+        """atomically replaces the state file"""
+        state_dir = os.path.dirname(os.path.abspath(self.state_file))
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+
+        tmp_file = f"{self.state_file}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(self.watermarks, f, indent=2, sort_keys=True)
+        os.replace(tmp_file, self.state_file)
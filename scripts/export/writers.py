@@ -0,0 +1,675 @@
+"""
+Row writers shared by the export scripts.
+
+Exporters describe their output as a list of (column name, column type) pairs
+and stream rows into a writer returned by open_row_writer. A row is either a
+dict keyed by column name or a tuple of the column values in column order,
+e.g. a named tuple, which is written without per column key lookups. For csv
+the column type is ignored, except that list of struct columns are written as
+JSON. For parquet and arrow (IPC stream) output the rows are buffered into
+record batches of ROW_GROUP_SIZE rows and written with typed, dictionary
+encoded columns.
+
+Column types:
+- string: utf8
+- category: dictionary encoded utf8, for low cardinality columns
+- int, float, bool
+- timestamp: epoch seconds, stored as a UTC millisecond timestamp
+- string_map: dict of str to str or any value with items(), e.g. a metric
+  slice or SliceKey
+- string_list: list of str, e.g. tags
+- list of (name, type) pairs: list of structs with those fields
+
+pyarrow is only needed for parquet and arrow output.
+
+Csv output can be compressed while streaming with gzip or zstd (zstd requires
+the zstandard package). Parquet and arrow use the compression as their
+internal codec. When max_rows or max_bytes is set the output is rotated into
+numbered parts `<file_base>.part-00000.<extension>` and a manifest
+`<file_base>.manifest.json` lists the row count and byte length of each part.
+The manifest is only written once all rows are written.
+
+Uncompressed and unrotated csv output can be appended to from an offset
+returned by RowWriter.resume_offset, see checkpoints.py.
+
+Instead of files, rows can be written to a sink, `sqlite:///<path>` upserts
+them into a table of a SQLite database, see open_sink_writer.
+"""
+
+import csv
+import gzip
+import io
+import json
+import os
+import sqlite3
+from typing import Callable, Optional, Union
+
+FORMATS = ["csv", "parquet", "arrow"]
+FILE_EXTENSIONS = {"csv": "csv", "parquet": "parquet", "arrow": "arrows"}
+
+COMPRESSIONS = ["none", "gzip", "zstd"]
+COMPRESSION_EXTENSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+# compression used by each format unless one is given
+DEFAULT_COMPRESSIONS = {"csv": "none", "parquet": "zstd", "arrow": "none"}
+
+ROW_GROUP_SIZE = 100_000
+
+SQLITE_SINK_PREFIX = "sqlite:///"
+
+# rows upserted per transaction
+SQLITE_TRANSACTION_ROWS = 100_000
+
+# seconds to wait for other processes writing to the same database
+SQLITE_TIMEOUT = 600
+
+
+def _import_zstandard():
+    try:
+        import zstandard
+    except ImportError as ex:
+        raise RuntimeError(
+            "zstd compression requires zstandard, run: pip install zstandard"
+        ) from ex
+    return zstandard
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as ex:
+        raise RuntimeError(
+            "parquet and arrow output require pyarrow, run: pip install pyarrow"
+        ) from ex
+    return pyarrow
+
+
+def _quote(identifier: str) -> str:
+    """quotes a SQLite table, index or column name"""
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def _to_timestamp_ms(value) -> Optional[int]:
+    if value is None or value == "":
+        return None
+    return int(float(value) * 1000)
+
+
+class RowWriter:
+    file_path: str
+    num_rows: int = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, row: Union[dict, tuple]):
+        raise NotImplementedError
+
+    def bytes_written(self) -> int:
+        """bytes written to disk so far, may lag behind buffered rows"""
+        raise NotImplementedError
+
+    def resume_offset(self) -> Optional[int]:
+        """
+        flushes the rows written so far and returns the offset a writer can
+        later append from, None when the output can not be appended to
+        """
+        return None
+
+    def close(self):
+        raise NotImplementedError
+
+
+class CsvRowWriter(RowWriter):
+    def __init__(
+        self,
+        file_path: str,
+        columns: list[tuple],
+        compression: str = "none",
+        compression_level: Optional[int] = None,
+        append_offset: Optional[int] = None,
+    ):
+        self.file_path = file_path
+        self.num_rows = 0
+        self._appendable = compression == "none"
+
+        if append_offset is not None:
+            if not self._appendable:
+                raise ValueError("compressed csv output can not be appended to")
+            if os.path.getsize(file_path) < append_offset:
+                raise ValueError(f"{file_path} is shorter than {append_offset} bytes")
+            # drops rows written after the offset, e.g. by an interrupted export
+            self._raw = open(file_path, "r+b")
+            self._raw.truncate(append_offset)
+            self._raw.seek(append_offset)
+        else:
+            self._raw = open(file_path, "wb")
+
+        if compression == "gzip":
+            level = 6 if compression_level is None else compression_level
+            stream = gzip.GzipFile(fileobj=self._raw, mode="wb", compresslevel=level)
+        elif compression == "zstd":
+            level = 3 if compression_level is None else compression_level
+            compressor = _import_zstandard().ZstdCompressor(level=level)
+            stream = compressor.stream_writer(self._raw, closefd=False)
+        else:
+            stream = self._raw
+
+        self._file = io.TextIOWrapper(stream, encoding="utf-8")
+        self._writer = csv.writer(self._file)
+        self._dict_writer = csv.DictWriter(
+            self._file, fieldnames=[name for name, _ in columns]
+        )
+        # list of struct columns, written as JSON rather than the python repr
+        self._json_columns = [
+            (i, name)
+            for i, (name, column_type) in enumerate(columns)
+            if isinstance(column_type, list)
+        ]
+        if append_offset is None:
+            self._dict_writer.writeheader()
+
+    def _to_json(self, row: Union[dict, tuple]) -> Union[dict, list]:
+        """returns a copy of the row with the list of struct columns as JSON"""
+        if isinstance(row, dict):
+            row = row.copy()
+            keys = [name for _, name in self._json_columns]
+        else:
+            row = list(row)
+            keys = [i for i, _ in self._json_columns]
+        for key in keys:
+            value = row.get(key) if isinstance(row, dict) else row[key]
+            if value not in (None, ""):
+                row[key] = json.dumps(value, ensure_ascii=False)
+        return row
+
+    def write(self, row: Union[dict, tuple]):
+        if self._json_columns:
+            row = self._to_json(row)
+        if isinstance(row, dict):
+            self._dict_writer.writerow(row)
+        else:
+            self._writer.writerow(row)
+        self.num_rows += 1
+
+    def bytes_written(self) -> int:
+        return self._raw.tell()
+
+    def resume_offset(self) -> Optional[int]:
+        if not self._appendable:
+            return None
+        self._file.flush()
+        return self._raw.tell()
+
+    def close(self):
+        self._file.close()
+        self._raw.close()
+
+
+class ArrowRowWriter(RowWriter):
+    def __init__(
+        self,
+        file_path: str,
+        columns: list[tuple],
+        file_format: str = "parquet",
+        compression: str = "none",
+        compression_level: Optional[int] = None,
+        row_group_size: int = ROW_GROUP_SIZE,
+    ):
+        self.pa = _import_pyarrow()
+        self.file_path = file_path
+        self.columns = columns
+        self.row_group_size = row_group_size
+        self.num_rows = 0
+        self._bytes_written = 0
+
+        self.schema = self.pa.schema(
+            [(name, self._arrow_type(column_type)) for name, column_type in columns]
+        )
+        if file_format == "parquet":
+            self._writer = self.pa.parquet.ParquetWriter(
+                file_path,
+                self.schema,
+                compression=compression,
+                compression_level=compression_level,
+            )
+        else:
+            if compression == "gzip":
+                raise ValueError("arrow output supports zstd compression only")
+            options = self.pa.ipc.IpcWriteOptions(
+                compression=self.pa.Codec(compression, compression_level)
+                if compression == "zstd"
+                else None
+            )
+            # the stream format allows the dictionaries to change between batches
+            self._writer = self.pa.ipc.new_stream(
+                file_path, self.schema, options=options
+            )
+
+        self._rows = []
+
+    def _arrow_type(self, column_type):
+        pa = self.pa
+        if isinstance(column_type, list):
+            return pa.list_(
+                pa.struct(
+                    [(name, self._arrow_type(field)) for name, field in column_type]
+                )
+            )
+        return {
+            "string": pa.string(),
+            "category": pa.dictionary(pa.int32(), pa.string()),
+            "int": pa.int64(),
+            "float": pa.float64(),
+            "bool": pa.bool_(),
+            "timestamp": pa.timestamp("ms", tz="UTC"),
+            "string_map": pa.map_(pa.string(), pa.string()),
+            "string_list": pa.list_(pa.string()),
+        }[column_type]
+
+    def _convert(self, column_type, value):
+        if value is None:
+            return None
+        if value == "" and column_type not in ("string", "category"):
+            return None
+        if isinstance(column_type, list):
+            return [
+                {
+                    name: self._convert(field, item.get(name))
+                    for name, field in column_type
+                }
+                for item in value
+            ]
+        if column_type == "timestamp":
+            return _to_timestamp_ms(value)
+        if column_type == "string_map":
+            return [(str(k), None if v is None else str(v)) for k, v in value.items()]
+        if column_type == "string_list":
+            return [str(v) for v in value]
+        if column_type in ("string", "category"):
+            return str(value)
+        return value
+
+    def _flush(self):
+        if not self._rows:
+            return
+
+        if isinstance(self._rows[0], dict):
+            column_values = [
+                [row.get(name) for row in self._rows] for name, _ in self.columns
+            ]
+        else:
+            column_values = zip(*self._rows)
+
+        arrays = []
+        for (_, column_type), field, values in zip(
+            self.columns, self.schema, column_values
+        ):
+            values = [self._convert(column_type, value) for value in values]
+            if column_type == "category":
+                array = self.pa.array(values, self.pa.string()).dictionary_encode()
+            elif column_type == "timestamp":
+                array = self.pa.array(values, self.pa.int64()).cast(field.type)
+            else:
+                array = self.pa.array(values, field.type)
+            arrays.append(array)
+
+        self._writer.write_batch(
+            self.pa.record_batch(arrays, schema=self.schema),
+        )
+        self._rows = []
+        self._bytes_written = os.path.getsize(self.file_path)
+
+    def write(self, row: Union[dict, tuple]):
+        self._rows.append(row)
+        self.num_rows += 1
+        if len(self._rows) >= self.row_group_size:
+            self._flush()
+
+    def bytes_written(self) -> int:
+        return self._bytes_written
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+class RotatingRowWriter(RowWriter):
+    """
+    Writes rows into numbered parts, starting a new part once the current one
+    holds max_rows rows or max_bytes bytes. Writes the manifest on close, a
+    writer left by an exception only closes its open part, so a partial set of
+    parts has no manifest.
+    """
+
+    def __init__(
+        self,
+        open_part: Callable[[str], RowWriter],
+        file_base: str,
+        extension: str,
+        max_rows: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        manifest_info: Optional[dict] = None,
+    ):
+        self.file_path = f"{file_base}.manifest.json"
+        self.num_rows = 0
+        self.parts = []
+
+        self._open_part = open_part
+        self._file_base = file_base
+        self._extension = extension
+        self._max_rows = max_rows
+        self._max_bytes = max_bytes
+        self._manifest_info = manifest_info or {}
+        self._part = None
+
+    def _close_part(self):
+        if self._part is None:
+            return
+        self._part.close()
+        self.parts.append(
+            {
+                "file": os.path.basename(self._part.file_path),
+                "rows": self._part.num_rows,
+                "bytes": os.path.getsize(self._part.file_path),
+            }
+        )
+        self._part = None
+
+    def write(self, row: Union[dict, tuple]):
+        if self._part is None:
+            self._part = self._open_part(
+                f"{self._file_base}.part-{len(self.parts):05d}.{self._extension}"
+            )
+
+        self._part.write(row)
+        self.num_rows += 1
+
+        if (self._max_rows and self._part.num_rows >= self._max_rows) or (
+            self._max_bytes and self._part.bytes_written() >= self._max_bytes
+        ):
+            self._close_part()
+
+    def bytes_written(self) -> int:
+        current = self._part.bytes_written() if self._part is not None else 0
+        return sum(part["bytes"] for part in self.parts) + current
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self._close_part()
+
+    def close(self):
+        self._close_part()
+        manifest = {
+            **self._manifest_info,
+            "rows": self.num_rows,
+            "bytes": sum(part["bytes"] for part in self.parts),
+            "parts": self.parts,
+        }
+        with open(self.file_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+
+
+class SqliteRowWriter(RowWriter):
+    """
+    Upserts rows into a SQLite table, created along with its indexes if it
+    does not exist. Rows with the same key_columns values as an existing row,
+    e.g. from an earlier export, replace it. Rows are inserted with
+    executemany, SQLITE_TRANSACTION_ROWS rows per transaction.
+
+    Timestamps are stored as epoch seconds, lists and dicts as JSON.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        table: str,
+        columns: list[tuple],
+        key_columns: list[str],
+        indexes: Optional[list[list[str]]] = None,
+        transaction_rows: int = SQLITE_TRANSACTION_ROWS,
+    ):
+        self.file_path = db_path
+        self.num_rows = 0
+        self.columns = columns
+        self.transaction_rows = transaction_rows
+
+        # transactions are started explicitly
+        self._conn = sqlite3.connect(
+            db_path, timeout=SQLITE_TIMEOUT, isolation_level=None
+        )
+        # lets the database be read, and other workers wait, while writing
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+        names = [name for name, _ in columns]
+        # NULLs are distinct in a unique index, so missing key values are
+        # compared as empty strings
+        key = ", ".join(f"ifnull({_quote(name)}, '')" for name in key_columns)
+        column_defs = ", ".join(
+            f"{_quote(name)} {self._sqlite_type(column_type)}"
+            for name, column_type in columns
+        )
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {_quote(table)} ({column_defs})"
+        )
+        self._conn.execute(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {_quote(table + '_key')} "
+            f"ON {_quote(table)} ({key})"
+        )
+        for index_columns in indexes or []:
+            index_name = _quote("_".join([table, *index_columns]))
+            self._conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {index_name} ON {_quote(table)} "
+                f"({', '.join(_quote(name) for name in index_columns)})"
+            )
+
+        updates = ", ".join(
+            f"{_quote(name)} = excluded.{_quote(name)}"
+            for name in names
+            if name not in key_columns
+        )
+        self._insert = (
+            f"INSERT INTO {_quote(table)} "
+            f"({', '.join(_quote(name) for name in names)}) "
+            f"VALUES ({', '.join('?' * len(names))}) "
+            f"ON CONFLICT ({key}) DO UPDATE SET {updates}"
+        )
+
+        # only columns that need converting are converted per row
+        self._converters = [
+            (i, self._converter(column_type))
+            for i, (_, column_type) in enumerate(columns)
+            if column_type not in ("string", "category")
+        ]
+        self._rows = []
+
+    @staticmethod
+    def _sqlite_type(column_type) -> str:
+        if isinstance(column_type, list):
+            return "TEXT"
+        return {
+            "int": "INTEGER",
+            "bool": "INTEGER",
+            "float": "REAL",
+            "timestamp": "REAL",
+        }.get(column_type, "TEXT")
+
+    @staticmethod
+    def _converter(column_type) -> Callable:
+        if column_type in ("string_map", "string_list") or isinstance(
+            column_type, list
+        ):
+
+            def convert(value):
+                if value is None or isinstance(value, str):
+                    return value or None
+                if isinstance(value, dict):
+                    return json.dumps(value, sort_keys=True, ensure_ascii=False)
+                return json.dumps(value, ensure_ascii=False)
+
+        else:
+
+            def convert(value):
+                return None if value == "" else value
+
+        return convert
+
+    def _flush(self):
+        if not self._rows:
+            return
+        self._conn.execute("BEGIN")
+        try:
+            self._conn.executemany(self._insert, self._rows)
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+        self._rows = []
+
+    def write(self, row: Union[dict, tuple]):
+        if isinstance(row, dict):
+            values = [row.get(name) for name, _ in self.columns]
+        else:
+            values = list(row)
+        for i, convert in self._converters:
+            values[i] = convert(values[i])
+
+        self._rows.append(values)
+        self.num_rows += 1
+        if len(self._rows) >= self.transaction_rows:
+            self._flush()
+
+    def bytes_written(self) -> int:
+        return os.path.getsize(self.file_path)
+
+    def close(self):
+        try:
+            self._flush()
+        finally:
+            self._conn.close()
+
+
+def open_sink_writer(
+    sink: str,
+    table: str,
+    columns: list[tuple],
+    key_columns: list[str],
+    indexes: Optional[list[list[str]]] = None,
+) -> RowWriter:
+    """
+    opens a writer upserting rows into `table` of the sink, identified by
+    key_columns. the caller must close the writer.
+    """
+    if not sink.startswith(SQLITE_SINK_PREFIX):
+        raise ValueError(
+            f"Unsupported sink: {sink}, expected {SQLITE_SINK_PREFIX}<path>"
+        )
+    return SqliteRowWriter(
+        sink[len(SQLITE_SINK_PREFIX) :], table, columns, key_columns, indexes
+    )
+
+
+def open_row_writer(
+    file_format: str,
+    file_base: str,
+    columns: list[tuple],
+    compression: Optional[str] = None,
+    compression_level: Optional[int] = None,
+    max_rows: Optional[int] = None,
+    max_bytes: Optional[int] = None,
+    append_offset: Optional[int] = None,
+) -> RowWriter:
+    """
+    opens a writer for `<file_base>.<extension>` in the given format, or for
+    numbered parts of it when max_rows or max_bytes is set. compression
+    defaults to DEFAULT_COMPRESSIONS of the format. with append_offset, an
+    existing uncompressed csv file is truncated to the offset and appended to.
+    the caller must close the writer.
+    """
+    if file_format not in FORMATS:
+        raise ValueError(f"Unsupported export format: {file_format}")
+    if compression is None:
+        compression = DEFAULT_COMPRESSIONS[file_format]
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unsupported compression: {compression}")
+
+    if append_offset is not None and (
+        file_format != "csv" or compression != "none" or max_rows or max_bytes
+    ):
+        raise ValueError("only uncompressed, unrotated csv output can be appended to")
+
+    extension = FILE_EXTENSIONS[file_format]
+    if file_format == "csv":
+        extension += COMPRESSION_EXTENSIONS[compression]
+
+        def open_part(file_path: str) -> RowWriter:
+            return CsvRowWriter(file_path, columns, compression, compression_level)
+
+    else:
+
+        def open_part(file_path: str) -> RowWriter:
+            return ArrowRowWriter(
+                file_path, columns, file_format, compression, compression_level
+            )
+
+    if not max_rows and not max_bytes:
+        if append_offset is not None:
+            return CsvRowWriter(
+                f"{file_base}.{extension}",
+                columns,
+                compression,
+                compression_level,
+                append_offset,
+            )
+        return open_part(f"{file_base}.{extension}")
+
+    return RotatingRowWriter(
+        open_part,
+        file_base,
+        extension,
+        max_rows,
+        max_bytes,
+        {"format": file_format, "compression": compression},
+    )
+
+
+def add_writer_arguments(parser, default_format: str = "csv"):
+    """adds the output format, compression and rotation options to parser"""
+    parser.add_argument(
+        "--format",
+        choices=FORMATS,
+        default=default_format,
+        help="Output file format, parquet and arrow require pyarrow",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=COMPRESSIONS,
+        help="Output compression, defaults to none for csv and arrow and zstd "
+        "for parquet. zstd requires zstandard for csv",
+    )
+    parser.add_argument(
+        "--compression-level", type=int, help="Compression level of the codec"
+    )
+    parser.add_argument(
+        "--max-rows-per-file",
+        type=int,
+        help="Rotate output into numbered parts of at most this many rows",
+    )
+    parser.add_argument(
+        "--max-bytes-per-file",
+        type=int,
+        help="Rotate output into numbered parts of about this many bytes",
+    )
+    parser.add_argument(
+        "--sink",
+        type=str,
+        help="Write rows to a database instead of files, sqlite:///<path> "
+        "upserts them into a SQLite database",
+    )
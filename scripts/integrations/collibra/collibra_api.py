@@ -1,17 +1,102 @@
 import base64
 import logging
 import os
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Iterator, Optional
+from urllib.parse import urlencode
 
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from scripts.common.concurrency import TokenBucket
+from scripts.common.instrumentation import Instrumentation
 
 load_dotenv(".env")
 
 logger = logging.getLogger(__name__)
 
+# connections kept open to the Collibra instance, override with
+# COLLIBRA_POOL_SIZE
+DEFAULT_POOL_SIZE = 10
+
+# retries of a request after a 429/5xx response or a connection error,
+# override with COLLIBRA_MAX_RETRIES. POST creates are not idempotent, they are
+# only retried when the request never reached Collibra
+DEFAULT_MAX_RETRIES = 5
+
+# the n-th retry waits a random time up to BACKOFF_BASE * 2**n seconds, capped
+# at BACKOFF_MAX, unless the response has a Retry-After header
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+# results per request when paging through a list endpoint
+DEFAULT_PAGE_SIZE = 1000
+
+
+def is_retryable_status(status_code: int) -> bool:
+    return status_code == 429 or status_code >= 500
+
+
+def is_connect_error(e: requests.RequestException) -> bool:
+    """whether the request failed before it was sent, e.g. connection refused"""
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    if not isinstance(e, requests.ConnectionError):
+        return False
+    reason = e.args[0] if e.args else None
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+    return isinstance(reason, NewConnectionError)
+
+
+def is_retryable(method: str, e: requests.RequestException) -> bool:
+    """
+    whether a failed request can be sent again. a POST that failed with a 5xx
+    or a lost connection may have been applied, retrying it could create
+    duplicates, so it is only retried on 429 or when it was never sent.
+    """
+    if isinstance(e, requests.HTTPError):
+        if method == "POST":
+            return e.response.status_code == 429
+        return is_retryable_status(e.response.status_code)
+    if method == "POST":
+        return is_connect_error(e)
+    return isinstance(e, requests.ConnectionError)
+
+
+def get_retry_after(response: requests.Response) -> Optional[float]:
+    """seconds to wait from the Retry-After header, in seconds or a date"""
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def get_backoff(retry: int) -> float:
+    """jittered exponential backoff before the given retry, counted from 0"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**retry))
+
 
 class CollibraAPI:
-    def __init__(self, log_level=logging.INFO):
+    def __init__(
+        self,
+        log_level=logging.INFO,
+        stats=None,
+        pool_size=None,
+        max_retries=None,
+        write_rate_limiter: Optional[TokenBucket] = None,
+    ):
         self.username = os.environ["COLLIBRA_USERNAME"]
         self.password = os.environ["COLLIBRA_PASSWORD"]
         self.rest_url = os.environ["COLLIBRA_REST_URL"]
@@ -19,6 +104,26 @@ class CollibraAPI:
             "Accept": "application/json",
             "Authorization": self.basic_auth_header(self.username, self.password),
         }
+        self.stats = stats or Instrumentation()
+
+        if pool_size is None:
+            pool_size = int(os.environ.get("COLLIBRA_POOL_SIZE", DEFAULT_POOL_SIZE))
+        if max_retries is None:
+            max_retries = int(
+                os.environ.get("COLLIBRA_MAX_RETRIES", DEFAULT_MAX_RETRIES)
+            )
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        # every write request, including retries, takes a token first
+        self.write_rate_limiter = write_rate_limiter or TokenBucket()
+
+        # a single session keeps connections alive across requests, retries
+        # are done in request() so they can be counted and logged
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
 
     @staticmethod
     def basic_auth_header(username, password):
@@ -28,34 +133,98 @@ class CollibraAPI:
         auth_header = f"Basic {encoded_string.decode('utf-8')}"
         return auth_header
 
+    @staticmethod
+    def endpoint_name(method, endpoint):
+        # e.g. "GET relations" for relations?targetId=...,
+        # "DELETE assets" for assets/<id>
+        return f"{method} {endpoint.split('?')[0].split('/')[0]}"
+
+    def close(self):
+        self.session.close()
+
+    def _send(self, method, url, data=None) -> requests.Response:
+        if method not in ("GET", "POST", "PUT", "DELETE", "PATCH"):
+            raise ValueError(f"Unsupported HTTP method: {method}")
+        if method in ("GET", "DELETE"):
+            return self.session.request(method, url)
+        return self.session.request(method, url, json=data)
+
     def request(self, method, endpoint, data=None):
+        """
+        sends the request, retrying 429/5xx responses and connection errors up
+        to max_retries times, see is_retryable for POST. returns the response
+        json, or None once the request failed for good.
+        """
         url = f"{self.rest_url}/{endpoint}"
+        endpoint_name = self.endpoint_name(method, endpoint)
         logger.info(f"METHOD: {method} {url}")
-        try:
-            if method == "GET":
-                response = requests.get(url, headers=self.headers)
-            elif method == "POST":
-                response = requests.post(url, headers=self.headers, json=data)
-            elif method == "PUT":
-                response = requests.put(url, headers=self.headers, json=data)
-            elif method == "DELETE":
-                response = requests.delete(url, headers=self.headers)
-            elif method == "PATCH":
-                response = requests.patch(url, headers=self.headers, json=data)
-            else:
-                raise ValueError(f"Unsupported HTTP method: {method}")
-
-            response.raise_for_status()
-
-            return response.json() if response.content else None
-
-        except requests.RequestException as e:
-            logger.error(f"Error during {method} request to {endpoint}: {str(e)}")
-            return None
+
+        retry = 0
+        while True:
+            start_ts = time.perf_counter()
+            ok = False
+            wait = None
+            try:
+                if method != "GET":
+                    self.write_rate_limiter.acquire()
+                response = self._send(method, url, data)
+                if is_retryable_status(response.status_code):
+                    wait = get_retry_after(response)
+                response.raise_for_status()
+                ok = True
+
+                return response.json() if response.content else None
+
+            except requests.RequestException as e:
+                if not is_retryable(method, e) or retry >= self.max_retries:
+                    logger.error(
+                        f"Error during {method} request to {endpoint}: {str(e)}"
+                    )
+                    return None
+
+                if wait is None:
+                    wait = get_backoff(retry)
+                logger.warning(
+                    f"Retrying {method} request to {endpoint} in {wait:.1f}s "
+                    f"after: {str(e)}"
+                )
+
+            finally:
+                self.stats.record_request(
+                    endpoint_name, time.perf_counter() - start_ts, ok
+                )
+
+            self.stats.record_retry(endpoint_name)
+            retry += 1
+            time.sleep(wait)
 
     def get(self, endpoint):
         return self.request("GET", endpoint)
 
+    def iter_results(
+        self, endpoint, params=None, page_size=DEFAULT_PAGE_SIZE
+    ) -> Iterator[dict]:
+        """
+        yields the results of a list endpoint such as assets, attributes or
+        relations, reading them page by page with offset and limit. raises if
+        a page can not be read, so a listing is never silently truncated.
+        """
+        offset = 0
+        while True:
+            query = urlencode(
+                {**(params or {}), "offset": offset, "limit": page_size}, doseq=True
+            )
+            response = self.get(f"{endpoint}?{query}")
+            if response is None:
+                raise RuntimeError(f"Failed to list {endpoint} at offset {offset}")
+
+            results = response["results"]
+            yield from results
+            offset += len(results)
+            # the instance may return fewer results per page than asked for
+            if not results or offset >= response.get("total", float("inf")):
+                return
+
     def post(self, endpoint, data):
         return self.request("POST", endpoint, data)
 
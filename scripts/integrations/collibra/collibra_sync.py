@@ -1,4 +1,7 @@
+import hashlib
+import json
 import logging
+from concurrent.futures import Future
 from datetime import datetime
 from typing import Optional
 from urllib.parse import urlencode
@@ -7,6 +10,10 @@ import pandas as pd
 from collibra_api import CollibraAPI
 from lightctl.lightup_client import LightupClient
 
+from scripts.common.concurrency import TokenBucket, WritePool
+from scripts.common.instrumentation import Instrumentation
+from scripts.common.metadata_cache import MetadataCache, list_workspace_metadata
+
 logger = logging.getLogger(__name__)
 
 INCIDENT_LOOKBACK_WINDOW = 60 * 60 * 24 * 7
@@ -24,6 +31,13 @@ ASSET_ID = "b4316413-0101-0101-0102-dab063b4c112"
 RELATION_TYPE_ID = "b4316413-0101-0101-0102-dab063b4c114"
 ASSIGMENT_ID = "3320dcb0-3b2d-4453-ade6-cde32045c618"
 
+# items per POST assets/bulk and attributes/bulk request
+ASSET_BATCH_SIZE = 500
+ATTRIBUTE_BATCH_SIZE = 1000
+
+# Collibra write requests in flight at a time
+WRITE_CONCURRENCY = 1
+
 
 def _make_url(
     cluster_name: str,
@@ -73,11 +87,47 @@ def make_metric_url(
 
 
 class CollibraSync:
-    def __init__(self, workspace_source_to_collibra_mapping: dict):
-        self.collibra = CollibraAPI(log_level=logging.INFO)
+    def __init__(
+        self,
+        workspace_source_to_collibra_mapping: dict,
+        asset_batch_size: int = ASSET_BATCH_SIZE,
+        attribute_batch_size: int = ATTRIBUTE_BATCH_SIZE,
+        write_concurrency: int = WRITE_CONCURRENCY,
+        write_rate_limit: Optional[float] = None,
+    ):
+        # phase timings and request latencies of the sync
+        self.stats = Instrumentation()
+        # at most write_rate_limit Collibra write requests are sent per second,
+        # counting the per item fallback of failed bulk writes and retries
+        self.collibra = CollibraAPI(
+            log_level=logging.INFO,
+            stats=self.stats,
+            write_rate_limiter=TokenBucket(write_rate_limit),
+        )
         self.lightup = LightupClient()
         self.workspace_source_to_collibra_mapping = workspace_source_to_collibra_mapping
         self.url_base = self.lightup.healthz.url_base
+        # reuses the Lightup listings of recent syncs when
+        # LIGHTSCRIPT_METADATA_CACHE_TTL is set, see metadata_cache.py
+        self.metadata_cache = MetadataCache(namespace=self.url_base)
+        # assets and attributes are created with the bulk endpoints, items that
+        # could not be created are collected in failures
+        self.asset_batch_size = asset_batch_size
+        self.attribute_batch_size = attribute_batch_size
+        self.failures = []
+        # Collibra writes run on write_concurrency threads, an asset is created
+        # before its attributes and both before the relations to its table
+        self.writes = WritePool(write_concurrency)
+        if write_concurrency > self.collibra.pool_size:
+            logger.warning(
+                f"write concurrency {write_concurrency} is above the "
+                f"{self.collibra.pool_size} pooled Collibra connections, "
+                f"set COLLIBRA_POOL_SIZE"
+            )
+
+    def close(self):
+        self.writes.close()
+        self.collibra.close()
 
     @staticmethod
     def get_lightup_attributes() -> dict:
@@ -417,7 +467,8 @@ class CollibraSync:
         self, monitors, metric_info_map, workspace, collibra_source_id
     ):
         # get all workspaces
-        workspaces = self.lightup.workspace.list_workspaces()
+        with self.stats.request("lightup list_workspaces"):
+            workspaces = self.lightup.workspace.list_workspaces()
 
         # for each workspace, get the workspace id and name to match with the workspace id from the mapping
         for ws in workspaces:
@@ -522,6 +573,17 @@ class CollibraSync:
 
         return key_to_table_info_map
 
+    def list_lightup_metadata(self, kind: str, workspace_id: str, list_fn) -> list:
+        """lists the workspace sources, metrics or monitors through the cache"""
+        return list_workspace_metadata(
+            self.metadata_cache,
+            kind,
+            workspace_id,
+            list_fn,
+            self.stats,
+            endpoint_prefix="lightup ",
+        )
+
     def get_lightup_state(
         self, lightup_workspace_id, lightup_source_id, collibra_source_id
     ):
@@ -540,9 +602,15 @@ class CollibraSync:
         # 2. For all monitors configured on the list of sources, get info about
         # the monitor as well as the underlying metric
 
-        sources = self.lightup.source.list_sources(lightup_workspace_id)
-        metrics = self.lightup.metric.list_metrics(lightup_workspace_id)
-        monitors = self.lightup.monitor.list_monitors(lightup_workspace_id)
+        sources = self.list_lightup_metadata(
+            "sources", lightup_workspace_id, self.lightup.source.list_sources
+        )
+        metrics = self.list_lightup_metadata(
+            "metrics", lightup_workspace_id, self.lightup.metric.list_metrics
+        )
+        monitors = self.list_lightup_metadata(
+            "monitors", lightup_workspace_id, self.lightup.monitor.list_monitors
+        )
 
         sources = [
             source
@@ -562,9 +630,10 @@ class CollibraSync:
         )
 
         # 3. Get incidents associated with the list of monitors.
-        incidents = self.lightup.incident.list_incidents(
-            lightup_workspace_id, start_ts=lookback_start_ts, end_ts=lookback_end_ts
-        )
+        with self.stats.request("lightup list_incidents"):
+            incidents = self.lightup.incident.list_incidents(
+                lightup_workspace_id, start_ts=lookback_start_ts, end_ts=lookback_end_ts
+            )
         for incident in incidents:
             monitor_uuid = incident.get("filter_uuid")
             if monitor_info := monitor_info_map.get(monitor_uuid):
@@ -579,14 +648,152 @@ class CollibraSync:
 
         return object_key_to_table_info_map
 
-    def update_collibra_attributes(self, assetId, typeId, value):
+    @staticmethod
+    def get_status(value) -> str:
+        if value["incidentCount"] > 0:
+            if value["ongoingIncidentCount"] == 0:
+                return '<div style="background-color: orange; width: 100.0px; padding: 3.0px; text-align: center; color: white; font-weight: bold;">Warning</div>'
+            return '<div style="background-color: red; width: 100.0px; padding: 3.0px; text-align: center; color: white; font-weight: bold;">Issue</div>'
+        return '<div style="background-color: green; width: 100.0px; padding: 3.0px; text-align: center; color: white; font-weight: bold;">Healthy</div>'
+
+    def get_attribute_payloads(self, asset_id, key, value) -> list[dict]:
         # Attributes for Asset Type Lightup Incident on Collibra
-        payload = {"assetId": assetId, "typeId": typeId, "value": value}
-        self.collibra.post(f"attributes", data=payload)
+        url = value["url"]
+        attributes = [
+            ("b4316413-0101-0101-0101-dab063b4c100", value["workspaceName"]),
+            ("b4316413-0101-0101-0101-dab063b4c101", value["monitorName"]),
+            ("b4316413-0101-0101-0101-dab063b4c102", value["metricName"]),
+            ("b4316413-0101-0101-0101-dab063b4c103", value["incidentCount"]),
+            ("b4316413-0101-0101-0101-dab063b4c104", self.get_status(value)),
+            (
+                "b4316413-0101-0101-0101-dab063b4c105",
+                f'<a href="{url}" target="_blank">View</a>',
+            ),
+            ("b4316413-0101-0101-0101-dab063b4c106", key[1]),
+            ("b4316413-0101-0101-0101-dab063b4c107", key[2]),
+            ("b4316413-0101-0101-0101-dab063b4c108", key[3]),
+            ("b4316413-0101-0101-0101-dab063b4c109", key[4]),
+        ]
+        return [
+            {"assetId": asset_id, "typeId": type_id, "value": attribute_value}
+            for type_id, attribute_value in attributes
+        ]
+
+    def write_batch(self, method: str, endpoint: str, batch: list[dict]) -> list:
+        """
+        creates (POST) or updates (PATCH) the items with <endpoint>/bulk and
+        returns the items that could not be written. Collibra rejects a bulk
+        request as a whole, so the items of a failed batch are written one at a
+        time to find and report the failed ones.
+        """
+        if not batch:
+            return []
+        if self.collibra.request(method, f"{endpoint}/bulk", batch) is not None:
+            return []
+
+        action = {"POST": "create", "PATCH": "update"}[method]
+        logger.warning(
+            f"Bulk {action} of {len(batch)} {endpoint} failed, "
+            f"writing them one at a time"
+        )
+        failed = []
+        for item in batch:
+            item_endpoint = endpoint
+            if method == "PATCH":
+                item_endpoint = f"{endpoint}/{item['id']}"
+            if self.collibra.request(method, item_endpoint, item) is None:
+                logger.error(f"Failed to {action} {endpoint[:-1]}: {item}")
+                failed.append(item)
+
+        if failed:
+            self.stats.count(f"failed_{action}_{endpoint}", len(failed))
+            self.failures.extend(
+                {"endpoint": endpoint, "action": action, "item": item}
+                for item in failed
+            )
+        return failed
+
+    def write_bulk(
+        self, method: str, endpoint: str, items: list[dict], batch_size: int
+    ) -> list[Future]:
+        """
+        submits write_batch for each batch of batch_size items to the write
+        pool, each future returns the items of its batch that failed
+        """
+        return [
+            self.writes.submit(
+                self.write_batch, method, endpoint, items[i : i + batch_size]
+            )
+            for i in range(0, len(items), batch_size)
+        ]
+
+    def create_attributes(self, asset_batch: Future, attributes: list[dict]) -> list:
+        # attributes of assets that could not be created are skipped
+        failed_asset_ids = {payload["id"] for payload in asset_batch.result()}
+        return self.write_batch(
+            "POST",
+            "attributes",
+            [
+                attribute
+                for attribute in attributes
+                if attribute["assetId"] not in failed_asset_ids
+            ],
+        )
+
+    def create_assets(self, assets: list[tuple]) -> tuple[set, list[Future]]:
+        """
+        creates the assets, a list of (asset payload, attribute payloads),
+        along with their attributes. the batches of assets are created
+        concurrently and the attributes of a batch once the batch is created.
+        returns the ids of the assets that could not be created and the
+        futures of the attribute writes.
+        """
+        asset_batches = []
+        attribute_batches = []
+        for i in range(0, len(assets), self.asset_batch_size):
+            batch = assets[i : i + self.asset_batch_size]
+            asset_batch = self.writes.submit(
+                self.write_batch, "POST", "assets", [payload for payload, _ in batch]
+            )
+            asset_batches.append(asset_batch)
+
+            attributes = [
+                attribute for _, attributes in batch for attribute in attributes
+            ]
+            for j in range(0, len(attributes), self.attribute_batch_size):
+                attribute_batches.append(
+                    self.writes.submit_after(
+                        [asset_batch],
+                        self.create_attributes,
+                        asset_batch,
+                        attributes[j : j + self.attribute_batch_size],
+                    )
+                )
+
+        failed_asset_ids = {
+            payload["id"] for future in asset_batches for payload in future.result()
+        }
+        return failed_asset_ids, attribute_batches
+
+    @staticmethod
+    def wait(futures: list[Future]) -> list:
+        """waits for the writes and returns their results"""
+        return [future.result() for future in futures]
+
+    @staticmethod
+    def get_asset_row(asset_id, key) -> dict:
+        return {
+            "collibra_asset_id": asset_id,
+            "database_name": key[1],
+            "schema_name": key[2],
+            "table_name": key[3],
+            "column_name": key[4],
+        }
 
     def update_collibra(self, object_key_to_table_info_map):
         asset_ids = []
 
+        assets = []
         for key, value_list in object_key_to_table_info_map.items():
             for value in value_list:
                 domainId = LIGHTUP_DOMAIN_ID
@@ -600,74 +807,144 @@ class CollibraSync:
                     "domainId": domainId,
                     "typeId": typeId,
                 }
+                # the asset id is the monitor uuid, as set in the payload
+                attributes = self.get_attribute_payloads(monitorUuid, key, value)
+                assets.append((payload, attributes))
+                asset_ids.append(self.get_asset_row(monitorUuid, key))
 
-                try:
-                    asset = self.collibra.post(f"assets", data=payload)
-                    get_asset_id = asset["id"]
-                except:
-                    continue
+        failed_asset_ids, attribute_batches = self.create_assets(assets)
+        # the attributes are created before the relations to the tables
+        self.wait(attribute_batches)
 
-                if value["incidentCount"] > 0:
-                    if value["ongoingIncidentCount"] == 0:
-                        status = '<div style="background-color: orange; width: 100.0px; padding: 3.0px; text-align: center; color: white; font-weight: bold;">Warning</div>'
-                    else:
-                        status = '<div style="background-color: red; width: 100.0px; padding: 3.0px; text-align: center; color: white; font-weight: bold;">Issue</div>'
-                else:
-                    status = '<div style="background-color: green; width: 100.0px; padding: 3.0px; text-align: center; color: white; font-weight: bold;">Healthy</div>'
-
-                url = value["url"]
-                self.update_collibra_attributes(
-                    get_asset_id,
-                    "b4316413-0101-0101-0101-dab063b4c100",
-                    value["workspaceName"],
-                )
-                self.update_collibra_attributes(
-                    get_asset_id,
-                    "b4316413-0101-0101-0101-dab063b4c101",
-                    value["monitorName"],
-                )
-                self.update_collibra_attributes(
-                    get_asset_id,
-                    "b4316413-0101-0101-0101-dab063b4c102",
-                    value["metricName"],
-                )
-                self.update_collibra_attributes(
-                    get_asset_id,
-                    "b4316413-0101-0101-0101-dab063b4c103",
-                    value["incidentCount"],
-                )
-                self.update_collibra_attributes(
-                    get_asset_id, "b4316413-0101-0101-0101-dab063b4c104", status
-                )
-                self.update_collibra_attributes(
-                    get_asset_id,
-                    "b4316413-0101-0101-0101-dab063b4c105",
-                    f'<a href="{url}" target="_blank">View</a>',
-                )
-                self.update_collibra_attributes(
-                    get_asset_id, "b4316413-0101-0101-0101-dab063b4c106", key[1]
-                )
-                self.update_collibra_attributes(
-                    get_asset_id, "b4316413-0101-0101-0101-dab063b4c107", key[2]
-                )
-                self.update_collibra_attributes(
-                    get_asset_id, "b4316413-0101-0101-0101-dab063b4c108", key[3]
-                )
-                self.update_collibra_attributes(
-                    get_asset_id, "b4316413-0101-0101-0101-dab063b4c109", key[4]
+        return [
+            row for row in asset_ids if row["collibra_asset_id"] not in failed_asset_ids
+        ]
+
+    @staticmethod
+    def normalize_attribute_value(value) -> str:
+        # numeric attributes may be returned as floats, e.g. 3.0 for 3
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        return str(value)
+
+    @classmethod
+    def get_content_hash(cls, name: str, attributes: dict) -> str:
+        """hash of an asset's name and attribute values by attribute type id"""
+        content = [name] + sorted(
+            (type_id, cls.normalize_attribute_value(value))
+            for type_id, value in attributes.items()
+        )
+        return hashlib.sha1(json.dumps(content).encode("utf-8")).hexdigest()
+
+    def get_collibra_state(self) -> dict:
+        """
+        returns the Lightup monitor assets in Collibra by asset id, each with
+        its name and its attributes by attribute type id
+        """
+        assets = self.collibra.iter_results(
+            "assets", {"typeId": ASSET_ID, "domainId": LIGHTUP_DOMAIN_ID}
+        )
+        state = {
+            asset["id"]: {"name": asset["name"], "attributes": {}} for asset in assets
+        }
+
+        type_ids = [attribute["id"] for attribute in self.get_lightup_attributes()]
+        for attribute in self.collibra.iter_results(
+            "attributes", {"typeIds": type_ids}
+        ):
+            if asset := state.get(attribute["asset"]["id"]):
+                asset["attributes"][attribute["type"]["id"]] = attribute
+        return state
+
+    def diff_collibra(self, desired: dict) -> set:
+        """
+        creates, updates and deletes Lightup monitor assets so Collibra matches
+        `desired`, a map of asset id to the object key and table info of its
+        monitor. an asset is only written when the content hash of its name
+        and attributes changed. returns the ids of the desired assets that
+        exist in Collibra afterwards.
+        """
+        current = self.get_collibra_state()
+
+        new_assets = []
+        new_attributes = []
+        renamed_assets = []
+        changed_attributes = []
+        for asset_id, (key, value) in desired.items():
+            payloads = self.get_attribute_payloads(asset_id, key, value)
+            asset = current.get(asset_id)
+            if asset is None:
+                new_assets.append(
+                    (
+                        {
+                            "name": asset_id,
+                            "id": asset_id,
+                            "displayName": asset_id,
+                            "domainId": LIGHTUP_DOMAIN_ID,
+                            "typeId": ASSET_ID,
+                        },
+                        payloads,
+                    )
                 )
+                continue
 
-                asset_ids.append(
-                    {
-                        "collibra_asset_id": get_asset_id,
-                        "database_name": key[1],
-                        "schema_name": key[2],
-                        "table_name": key[3],
-                        "column_name": key[4],
-                    }
+            current_hash = self.get_content_hash(
+                asset["name"],
+                {
+                    type_id: attribute["value"]
+                    for type_id, attribute in asset["attributes"].items()
+                },
+            )
+            desired_hash = self.get_content_hash(
+                asset_id, {payload["typeId"]: payload["value"] for payload in payloads}
+            )
+            if current_hash == desired_hash:
+                self.stats.count("assets_unchanged")
+                continue
+
+            self.stats.count("assets_updated")
+            if asset["name"] != asset_id:
+                renamed_assets.append(asset_id)
+            for payload in payloads:
+                attribute = asset["attributes"].get(payload["typeId"])
+                if attribute is None:
+                    new_attributes.append(payload)
+                elif self.normalize_attribute_value(
+                    attribute["value"]
+                ) != self.normalize_attribute_value(payload["value"]):
+                    changed_attributes.append(
+                        {"id": attribute["id"], "value": payload["value"]}
+                    )
+
+        # the writes of different assets are independent, only the attributes
+        # of new assets wait for their asset
+        writes = []
+        for asset_id in renamed_assets:
+            writes.append(
+                self.writes.submit(
+                    self.collibra.patch,
+                    f"assets/{asset_id}",
+                    {"name": asset_id, "displayName": asset_id},
                 )
+            )
+        writes += self.write_bulk(
+            "POST", "attributes", new_attributes, self.attribute_batch_size
+        )
+        writes += self.write_bulk(
+            "PATCH", "attributes", changed_attributes, self.attribute_batch_size
+        )
+        for asset_id in current.keys() - desired.keys():
+            writes.append(
+                self.writes.submit(self.collibra.delete, f"assets/{asset_id}")
+            )
+            self.stats.count("assets_deleted")
+
+        failed_asset_ids, attribute_batches = self.create_assets(new_assets)
+        if new_assets:
+            self.stats.count("assets_created", len(new_assets) - len(failed_asset_ids))
+        self.wait(writes + attribute_batches)
 
-        return asset_ids
+        return desired.keys() - failed_asset_ids
 
     def collibra_tables(self, source_data, target_data):
         # Define the source data
@@ -714,77 +991,224 @@ class CollibraSync:
 
         return results
 
-    def run(self):
-        # for collibra source id in the mapping run the sync for each source id
-        for cs in self.workspace_source_to_collibra_mapping["collibra_sources"]:
-            # for each sync, get the lightup source id and collibra source id to match with the source id from the mapping and run the sync
-            collibra_source = cs["collibra_source_id"]
+    def get_collibra_tables(self, collibra_source) -> list[dict]:
+        tables = self.collibra.iter_results(
+            "assets", {"typeId": TABLE_ASSET_TYPE_ID, "domainId": collibra_source}
+        )
 
-            # get all assets id created by update_collibra function
-            metrics_list = []
+        collibra_tables_list = []
+
+        for a in tables:
+            # breadcrumb = self.collibra.get(f"assets/{a['id']}/breadcrumb")
+            # breadcrumb = ' > '.join(d['name'] for d in breadcrumb)
+            # print(f"{breadcrumb} > {a['name']}")
+            # print(a['id'], a['name'], a['domain']['id'], a['domain']['name'].lower())
+
+            collibra_tables_list.append(
+                {
+                    "table_id": a["id"],
+                    "table_name": a["name"],
+                    "schema_id": a["domain"]["id"],
+                    "schema_name": a["domain"]["name"].lower(),
+                }
+            )
+
+        return collibra_tables_list
 
-            response = self.collibra.get(
-                f"assets?typeId={TABLE_ASSET_TYPE_ID}&domainId={collibra_source}"
+    def get_relations_by_target(self) -> dict:
+        """
+        returns the relations of the Lightup relation type by target asset id,
+        the relations of all tables are read in a few paged requests instead
+        of one request per table
+        """
+        relations_by_target = {}
+        for relation in self.collibra.iter_results(
+            "relations", {"relationTypeId": RELATION_TYPE_ID}
+        ):
+            relations_by_target.setdefault(relation["target"]["id"], []).append(
+                relation
             )
+        return relations_by_target
 
-            collibra_tables_list = []
+    def update_relations(
+        self, metrics_list, collibra_tables_list, current_relations=None
+    ):
+        """
+        relates each table to the assets created for it. with current_relations,
+        a map of table id to the ids of its related assets, the relations of a
+        table are only written when they changed.
+        """
+        tables = self.collibra_tables(metrics_list, collibra_tables_list)
 
-            for a in response["results"]:
-                # breadcrumb = self.collibra.get(f"assets/{a['id']}/breadcrumb")
-                # breadcrumb = ' > '.join(d['name'] for d in breadcrumb)
-                # print(f"{breadcrumb} > {a['name']}")
-                # print(a['id'], a['name'], a['domain']['id'], a['domain']['name'].lower())
+        writes = []
+        for table in tables:
+            ids = []
 
-                # get all assets with the same target id and relation type id
-                response = self.collibra.get(
-                    f"relations?targetId={a['id']}&relationTypeId={RELATION_TYPE_ID}"
-                )
+            colibra_table_id = table["colibra_table_id"]
+            metrics_sources = table["metrics_sources"]
+            for metric in metrics_sources:
+                collibra_asset_id = metric["collibra_asset_id"]
+                ids.append(collibra_asset_id)
 
-                if response and response["total"] > 0:
-                    # delete all assets with the same target id and relation type id
-                    for r in response["results"]:
-                        self.collibra.delete(f"assets/{r['source']['id']}")
-                else:
-                    print("No assets found")
-
-                collibra_tables_list.append(
-                    {
-                        "table_id": a["id"],
-                        "table_name": a["name"],
-                        "schema_id": a["domain"]["id"],
-                        "schema_name": a["domain"]["name"].lower(),
-                    }
+            if current_relations is not None and set(ids) == current_relations.get(
+                colibra_table_id, set()
+            ):
+                continue
+
+            # create relation between collibra source and all assets id created by update_collibra function
+            payload = {
+                "typeId": RELATION_TYPE_ID,
+                "relatedAssetIds": ids,
+                "relationDirection": "TO_SOURCE",
+            }
+
+            # update relation between collibra source and all assets id created by update_collibra function
+            writes.append(
+                self.writes.submit(
+                    self.collibra.put,
+                    f"assets/{colibra_table_id}/relations",
+                    payload,
                 )
+            )
+
+        self.wait(writes)
+        logger.info("Updated all Lightup Collibra objects")
+
+    def run(self, diff: bool = False):
+        """
+        syncs the Lightup monitors of the mapped sources to Collibra. by
+        default the monitor assets of each Collibra table are deleted and
+        recreated, with diff=True only the assets that changed are written, see
+        run_diff.
+        """
+        if diff:
+            self.run_diff()
+            return
+
+        with self.stats.span("clear_table_relations"):
+            relations_by_target = self.get_relations_by_target()
+
+        # for collibra source id in the mapping run the sync for each source id
+        for cs in self.workspace_source_to_collibra_mapping["collibra_sources"]:
+            # for each sync, get the lightup source id and collibra source id to match with the source id from the mapping and run the sync
+            collibra_source = cs["collibra_source_id"]
+
+            # get all assets id created by update_collibra function
+            metrics_list = []
+
+            with self.stats.span("clear_table_relations"):
+                collibra_tables_list = self.get_collibra_tables(collibra_source)
+
+                deletes = []
+                for table in collibra_tables_list:
+                    relations = relations_by_target.get(table["table_id"])
+                    if relations:
+                        # delete all assets with the same target id and relation type id
+                        for r in relations:
+                            deletes.append(
+                                self.writes.submit(
+                                    self.collibra.delete, f"assets/{r['source']['id']}"
+                                )
+                            )
+                    else:
+                        print("No assets found")
+                # the assets are deleted before they are created again
+                self.wait(deletes)
 
             for ls in cs["lightup_sources"]:
                 workspace_id = ls["workspace_id"]
                 lightup_source_id = ls["lightup_source_id"]
-                object_key_to_table_info_map = self.get_lightup_state(
-                    workspace_id, lightup_source_id, collibra_source
-                )
-                collibra_ids = self.update_collibra(object_key_to_table_info_map)
+                with self.stats.span("lightup_state"):
+                    object_key_to_table_info_map = self.get_lightup_state(
+                        workspace_id, lightup_source_id, collibra_source
+                    )
+                with self.stats.span("update_collibra"):
+                    collibra_ids = self.update_collibra(object_key_to_table_info_map)
 
                 # merge all assets id created by update_collibra function
                 metrics_list.extend(collibra_ids)
 
-            tables = self.collibra_tables(metrics_list, collibra_tables_list)
+            with self.stats.span("update_relations"):
+                self.update_relations(metrics_list, collibra_tables_list)
 
-            for table in tables:
-                ids = []
+        self.log_summary()
 
-                colibra_table_id = table["colibra_table_id"]
-                metrics_sources = table["metrics_sources"]
-                for metric in metrics_sources:
-                    collibra_asset_id = metric["collibra_asset_id"]
-                    ids.append(collibra_asset_id)
+    def run_diff(self):
+        """
+        differential sync: compares the desired monitor assets of all mapped
+        sources with the Lightup assets in Collibra and only creates, updates
+        or deletes the assets whose content changed, and only rewrites the
+        relations of tables whose related assets changed. assets of monitors
+        that are no longer mapped are deleted.
+        """
+        # asset id -> (object key, table info) of the monitor
+        desired = {}
+        collibra_sources = []
 
-                # create relation between collibra source and all assets id created by update_collibra function
-                payload = {
-                    "typeId": RELATION_TYPE_ID,
-                    "relatedAssetIds": ids,
-                    "relationDirection": "TO_SOURCE",
+        with self.stats.span("table_relations"):
+            relations_by_target = self.get_relations_by_target()
+
+        for cs in self.workspace_source_to_collibra_mapping["collibra_sources"]:
+            collibra_source = cs["collibra_source_id"]
+
+            with self.stats.span("table_relations"):
+                collibra_tables_list = self.get_collibra_tables(collibra_source)
+                current_relations = {
+                    table["table_id"]: {
+                        r["source"]["id"]
+                        for r in relations_by_target.get(table["table_id"], [])
+                    }
+                    for table in collibra_tables_list
                 }
 
-                # update relation between collibra source and all assets id created by update_collibra function
-                self.collibra.put(f"assets/{colibra_table_id}/relations", data=payload)
-                logger.info("Updated all Lightup Collibra objects")
+            metrics_list = []
+            for ls in cs["lightup_sources"]:
+                with self.stats.span("lightup_state"):
+                    object_key_to_table_info_map = self.get_lightup_state(
+                        ls["workspace_id"], ls["lightup_source_id"], collibra_source
+                    )
+                for key, value_list in object_key_to_table_info_map.items():
+                    for value in value_list:
+                        asset_id = value["monitorUuid"]
+                        # as with recreating, a monitor is only synced once
+                        if asset_id in desired:
+                            continue
+                        desired[asset_id] = (key, value)
+                        metrics_list.append(self.get_asset_row(asset_id, key))
+
+            collibra_sources.append(
+                (metrics_list, collibra_tables_list, current_relations)
+            )
+
+        with self.stats.span("update_collibra"):
+            asset_ids = self.diff_collibra(desired)
+
+        with self.stats.span("update_relations"):
+            for (
+                metrics_list,
+                collibra_tables_list,
+                current_relations,
+            ) in collibra_sources:
+                # relations of deleted assets were deleted along with them
+                current_relations = {
+                    table_id: related_ids & asset_ids
+                    for table_id, related_ids in current_relations.items()
+                }
+                self.update_relations(
+                    [
+                        row
+                        for row in metrics_list
+                        if row["collibra_asset_id"] in asset_ids
+                    ],
+                    collibra_tables_list,
+                    current_relations,
+                )
+
+        self.log_summary()
+
+    def log_summary(self):
+        if self.failures:
+            logger.error(
+                f"{len(self.failures)} Collibra assets/attributes could not be written"
+            )
+        logger.info(f"Collibra sync stats:\n{self.stats.summary()}")
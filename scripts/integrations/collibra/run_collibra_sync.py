@@ -1,13 +1,33 @@
 # Example usage for CollibraSync
+import argparse
+
 import yaml
-from collibra_sync import CollibraSync
+from collibra_sync import (
+    ASSET_BATCH_SIZE,
+    ATTRIBUTE_BATCH_SIZE,
+    WRITE_CONCURRENCY,
+    CollibraSync,
+)
 
 with open("source_map_config.yaml") as f:
     SOURCE_MAP = yaml.safe_load(f)
 
 
-def main():
-    collibra_sync = CollibraSync(SOURCE_MAP)
+def main(
+    stats_file=None,
+    asset_batch_size=ASSET_BATCH_SIZE,
+    attribute_batch_size=ATTRIBUTE_BATCH_SIZE,
+    diff=False,
+    write_concurrency=WRITE_CONCURRENCY,
+    write_rate_limit=None,
+):
+    collibra_sync = CollibraSync(
+        SOURCE_MAP,
+        asset_batch_size,
+        attribute_batch_size,
+        write_concurrency,
+        write_rate_limit,
+    )
 
     # uncomment to clear collibra state
     # collibra_sync.clear_collibra()
@@ -15,8 +35,61 @@ def main():
     # uncomment to prepare collibra (one time)
     # collibra_sync.prepare_collibra()
 
-    collibra_sync.run()
+    try:
+        collibra_sync.run(diff=diff)
+    finally:
+        collibra_sync.close()
+
+    print(collibra_sync.stats.summary())
+    for failure in collibra_sync.failures:
+        print(f"failed to {failure['action']} {failure['endpoint']}: {failure['item']}")
+    if stats_file:
+        collibra_sync.stats.write_json(stats_file)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Sync Lightup monitors to Collibra")
+    parser.add_argument(
+        "--stats-file",
+        type=str,
+        help="Write phase timings and request latencies to this json file",
+    )
+    parser.add_argument(
+        "--asset-batch-size",
+        type=int,
+        default=ASSET_BATCH_SIZE,
+        help="Assets created per bulk request",
+    )
+    parser.add_argument(
+        "--attribute-batch-size",
+        type=int,
+        default=ATTRIBUTE_BATCH_SIZE,
+        help="Attributes created per bulk request",
+    )
+    parser.add_argument(
+        "--diff",
+        action="store_true",
+        help="Only write the monitor assets and relations that changed instead "
+        "of deleting and recreating them",
+    )
+    parser.add_argument(
+        "--write-concurrency",
+        type=int,
+        default=WRITE_CONCURRENCY,
+        help="Number of Collibra write requests in flight at a time",
+    )
+    parser.add_argument(
+        "--write-rate-limit",
+        type=float,
+        help="Maximum Collibra write requests per second",
+    )
+    args = parser.parse_args()
+
+    main(
+        args.stats_file,
+        args.asset_batch_size,
+        args.attribute_batch_size,
+        args.diff,
+        args.write_concurrency,
+        args.write_rate_limit,
+    )
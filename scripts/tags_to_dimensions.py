@@ -8,6 +8,8 @@ from typing import Dict
 from lightctl.client.metric_client import MetricClient
 from lightctl.client.workspace_client import WorkspaceClient
 
+from scripts.common.metadata_cache import MetadataCache
+
 # comparison is done after tag is made lower case.
 # update this map with configured tag to dimension equivalent
 TAGS_TO_DIMENSION_MAP = {
@@ -30,6 +32,10 @@ logger = logging.getLogger(__name__)
 wc = WorkspaceClient()
 mc = MetricClient()
 
+# metrics are listed from the API so a stale cached config is never sent back,
+# the updates are written through to the cache of the read only scripts
+metadata_cache = MetadataCache(namespace=mc.url_base)
+
 
 def update_dimension_from_tag(workspace_id: str, metric: Dict) -> bool:
     """
@@ -52,7 +58,8 @@ def update_dimension_from_tag(workspace_id: str, metric: Dict) -> bool:
         else:
             logger.info(output_str)
             metric["config"]["dimension"] = dimension
-            mc.update_metric(workspace_id, metric["metadata"]["uuid"], metric)
+            updated = mc.update_metric(workspace_id, metric["metadata"]["uuid"], metric)
+            metadata_cache.update("metrics", workspace_id, updated)
             return True  # updated
 
     return False  # not updated
@@ -1,9 +1,15 @@
 from lightctl.client.metric_client import MetricClient
 from lightctl.client.workspace_client import WorkspaceClient
 
+from scripts.common.metadata_cache import MetadataCache
+
 wc = WorkspaceClient()
 mc = MetricClient()
 
+# metrics are listed from the API so a stale cached config is never sent back,
+# the updates are written through to the cache of the read only scripts
+metadata_cache = MetadataCache(namespace=mc.url_base)
+
 workspaces = wc.list_workspaces()
 
 for workspace in workspaces:
@@ -33,4 +39,7 @@ for workspace in workspaces:
                 )
             if unpause.lower() == "yes":
                 metric["config"]["isLive"] = True
-                mc.update_metric(workspace_id, metric["metadata"]["uuid"], metric)
+                updated = mc.update_metric(
+                    workspace_id, metric["metadata"]["uuid"], metric
+                )
+                metadata_cache.update("metrics", workspace_id, updated)
@@ -18,6 +18,8 @@ It reconfigures the monitors by:
 from lightctl.client.metric_client import MetricClient
 from lightctl.client.monitor_client import MonitorClient
 
+from scripts.common.metadata_cache import MetadataCache
+
 # update these with the values.
 WORKSPACE_ID = "updateme"  # workspace uuid
 SCHEMA_NAME = "updateme"  # schema name
@@ -27,6 +29,10 @@ DRY_RUN = True  # set to False to update configuration
 monitor_client = MonitorClient()
 metric_client = MetricClient()
 
+# monitors are listed from the API so a stale cached config is never sent
+# back, the updates are written through to the cache of the read only scripts
+metadata_cache = MetadataCache(namespace=metric_client.url_base)
+
 
 def monitor_str(monitor):
     return f'{monitor["metadata"]["name"]} ({monitor["metadata"]["uuid"]})'
@@ -99,9 +105,12 @@ def update_aggressiveness_retrain_and_enable(monitors):
             symptom_config["aggressiveness"] = {"level": 3}
             monitor["config"]["symptom"] = symptom_config
             monitor["config"]["isLive"] = True
-            monitor_client.update_monitor(
+            updated = monitor_client.update_monitor(
                 monitor["metadata"]["workspaceId"], monitor["metadata"]["uuid"], monitor
             )
+            metadata_cache.update(
+                "monitors", monitor["metadata"]["workspaceId"], updated
+            )
 
             print(f"monitor update succeeded - {monitor['metadata']['uuid']}")
 